@@ -0,0 +1,5 @@
+"""Нагрузочное тестирование бота с локальными заглушками Telegram, DeepInfra и Stability.
+
+Запуск: python -m loadtest --updates 2000 --concurrency 200
+Замер холодного запуска: python -m loadtest.startup --runs 5
+"""
@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import json
+
+from loadtest.driver import run_load_test
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m loadtest", description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--updates", type=int, default=500, help="Число сценариев (вопрос или запрос изображения)")
+    parser.add_argument("--concurrency", type=int, default=100, help="Сценариев, выполняемых одновременно")
+    parser.add_argument("--image-ratio", type=float, default=0.2, help="Доля запросов изображений")
+    parser.add_argument("--distinct-prompts", type=int, default=0, help="Число различных текстов (0 - все разные)")
+    parser.add_argument("--latency", type=float, default=0.2, help="Задержка ответа DeepInfra, сек.")
+    parser.add_argument("--answer-words", type=int, default=60, help="Слов в ответе DeepInfra (больше ~500 - ответ из нескольких сообщений)")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="Пауза между фрагментами потокового ответа, сек.")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="Задержка ответа Stability, сек.")
+    parser.add_argument("--image-bytes", type=int, default=200_000, help="Размер одного изображения, байт")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка ответа Bot API, сек.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайная добавка к задержкам, сек.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500 от DeepInfra и Stability")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429 от всех заглушек")
+    parser.add_argument("--retry-after", type=int, default=1, help="Значение Retry-After в ответах 429, сек.")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True, help="Потоковые ответы чата")
+    parser.add_argument("--seed", type=int, default=1, help="Зерно генератора сценариев")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Дополнительная настройка бота ($DEEPINFRA, $STABILITY и $TELEGRAM заменяются адресами заглушек)")
+    parser.add_argument("--log-level", default="error", help="Уровень логов бота во время теста")
+    parser.add_argument("--tracemalloc", action="store_true", help="Измерять пиковое выделение памяти Python")
+    parser.add_argument("--json", action="store_true", help="Вывести отчет в формате JSON")
+    return parser.parse_args(argv)
+
+
+def print_report(report):
+    print(f"Сценариев: {report['scenarios']}, обновлений: {report['updates']}, время: {report['duration_s']} с")
+    print(f"Пропускная способность: {report['throughput_updates_per_s']} обновлений/с (импорт бота: {report['import_s']} с)")
+    for title, key in (("Длительность обработки", "handler_latency_ms"), ("До первого сообщения", "time_to_first_message_ms")):
+        for kind, stats in report[key].items():
+            if stats["count"]:
+                print(f"{title} ({kind}), мс: p50={stats['p50']} p95={stats['p95']} p99={stats['p99']} max={stats['max']} (n={stats['count']})")
+    stats = report["time_to_image_ms"]
+    if stats["count"]:
+        print(f"До отправки изображений, мс: p50={stats['p50']} p95={stats['p95']} p99={stats['p99']} max={stats['max']} (n={stats['count']})")
+    print(f"Задачи генерации изображений: {report['image_jobs']}")
+    print(f"Вызовы Bot API: {report['telegram_calls']}")
+    print(f"Вызовы DeepInfra: {report['deepinfra_calls']}, Stability: {report['stability_calls']}")
+    print(f"Запросы по моделям: {report['deepinfra_models']}, маршрутизация: {report['router_events']}")
+    print(f"Внесенные ошибки: {report['injected_faults']}")
+    print(f"Повторы к API: {report['upstream_retries']}, повторы Telegram: {report['telegram_retries']}, "
+          f"неудачные отправки: {report['telegram_failures']}, объединенные запросы: {report['coalesced_requests']}")
+    print(f"Отклонено по квотам: {report['quota_rejections']}")
+    print(f"Сбои сценариев: {report['failures'] or 'нет'}")
+    memory = f"Пиковая память процесса: {report['max_rss_mb']} МБ"
+    if "tracemalloc_peak_mb" in report:
+        memory += f", пик выделений Python: {report['tracemalloc_peak_mb']} МБ"
+    print(memory)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = asyncio.run(run_load_test(options))
+    if options.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
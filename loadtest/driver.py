@@ -0,0 +1,236 @@
+"""Прогон синтетических обновлений через диспетчер бота и сбор показателей"""
+
+import asyncio
+import importlib
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from loadtest.mock_servers import FaultInjection, MockDeepInfra, MockStability, MockTelegram
+
+TEST_TOKEN = "123456:LOADTEST"
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def summarize(values):
+    """Краткая сводка по списку длительностей, мс"""
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.50) * 1000, 1),
+        "p95": round(percentile(values, 0.95) * 1000, 1),
+        "p99": round(percentile(values, 0.99) * 1000, 1),
+        "max": round(max(values, default=0) * 1000, 1),
+    }
+
+
+def counter_total(metric):
+    """Сумма значений счетчика из main.py по всем меткам"""
+    return sum(metric._values.values())
+
+
+def build_environment(options, telegram, deepinfra, stability, work_dir):
+    """Переменные окружения, направляющие бота на заглушки"""
+    environment = {
+        "TELEGRAM_TOKEN": TEST_TOKEN,
+        "TELEGRAM_API_URL": telegram.base_url,
+        "DEEPINFRA_API_KEY": "loadtest",
+        "DEEPINFRA_API_URL": f"{deepinfra.base_url}/v1/openai/chat/completions",
+        "STABILITY_API_KEY": "loadtest",
+        "STABILITY_TEXT_TO_IMAGE_URL": f"{stability.base_url}/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image",
+        "STREAM_RESPONSES": "true" if options.stream else "false",
+        "STREAM_EDIT_INTERVAL": "0.2",
+        "CACHE_DB_PATH": "",
+        "IMAGE_JOBS_DB_PATH": os.path.join(work_dir, "jobs.db"),
+        "QUOTA_SNAPSHOT_PATH": os.path.join(work_dir, "quotas.json"),
+        "STORAGE_BACKEND": "memory",
+        "LOG_DIR": os.path.join(work_dir, "logs"),
+        # Лимиты частоты по умолчанию рассчитаны на реальные API и ограничили бы пропускную способность теста
+        "DEEPINFRA_CHAT_RATE_LIMIT": "1000",
+        "DEEPINFRA_TRANSLATE_RATE_LIMIT": "1000",
+        "STABILITY_RATE_LIMIT": "1000",
+        "DEEPINFRA_MAX_CONCURRENCY": "64",
+        "STABILITY_MAX_CONCURRENCY": "16",
+        "IMAGE_WORKERS": "16",
+        "TELEGRAM_GLOBAL_RATE": "1000",
+    }
+    for item in options.env:
+        key, _, value = item.partition("=")
+        # В значениях можно ссылаться на адреса заглушек, которые известны только после запуска
+        for placeholder, server in (("$TELEGRAM", telegram), ("$DEEPINFRA", deepinfra), ("$STABILITY", stability)):
+            value = value.replace(placeholder, server.base_url)
+        environment[key] = value
+    return environment
+
+
+def build_scenarios(options):
+    """Сценарии нагрузки: вопрос в чат или запрос изображения (/image, затем описание)"""
+    rng = random.Random(options.seed)
+    distinct = max(1, options.distinct_prompts or options.updates)
+    scenarios = []
+    for number in range(options.updates):
+        prompt_number = rng.randrange(distinct)
+        if rng.random() < options.image_ratio:
+            scenarios.append(("image", f"Кот в космосе, вариант {prompt_number}"))
+        else:
+            scenarios.append(("chat", f"Расскажи что-нибудь интересное, тема номер {prompt_number}"))
+    return scenarios
+
+
+class UpdateFactory:
+    """Создание синтетических обновлений Telegram"""
+
+    def __init__(self, main_module):
+        self.main = main_module
+        self.update_id = 0
+        self.message_id = 0
+
+    def message(self, chat_id, user_id, text):
+        self.update_id += 1
+        self.message_id += 1
+        data = {
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                "text": text,
+            },
+        }
+        return self.main.types.Update.model_validate(data, context={"bot": self.main.bot})
+
+
+async def run_load_test(options):
+    """Запуск заглушек, импорт бота и прогон сценариев; возвращает отчет"""
+    faults = dict(
+        jitter=options.jitter,
+        rate_limit_ratio=options.rate_limit_rate,
+        error_ratio=options.error_rate,
+        retry_after=options.retry_after,
+    )
+    telegram = MockTelegram(FaultInjection(latency=options.telegram_latency, **dict(faults, error_ratio=0)))
+    deepinfra = MockDeepInfra(
+        FaultInjection(latency=options.latency, **faults), answer_words=options.answer_words, token_delay=options.token_delay
+    )
+    stability = MockStability(FaultInjection(latency=options.image_latency, **faults), image_bytes=options.image_bytes)
+    for server in (telegram, deepinfra, stability):
+        await server.start()
+
+    work_dir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update(build_environment(options, telegram, deepinfra, stability, work_dir))
+    if options.tracemalloc:
+        tracemalloc.start()
+
+    # Бот читает настройки при импорте, поэтому импорт выполняется только после настройки окружения
+    started = time.perf_counter()
+    main = importlib.import_module("main")
+    import_seconds = time.perf_counter() - started
+    logging.getLogger().setLevel(getattr(logging, options.log_level.upper()))
+
+    main.http_session = main.create_http_session()
+    main.image_jobs.start(main.run_image_job)
+    factory = UpdateFactory(main)
+    scenarios = build_scenarios(options)
+    semaphore = asyncio.Semaphore(options.concurrency)
+    handler_latencies = {"chat": [], "image": []}
+    first_response = {"chat": [], "image": []}
+    first_image = []
+    started_at = {}  # chat_id -> (тип сценария, время отправки измеряемого обновления)
+    failures = Counter()
+
+    async def feed(chat_id, text):
+        update = factory.message(chat_id, chat_id, text)
+        await main.dp.feed_update(main.bot, update)
+
+    async def run_scenario(number, kind, text):
+        chat_id = 100_000 + number
+        async with semaphore:
+            try:
+                if kind == "image":
+                    await feed(chat_id, "/image")
+                    telegram.first_response_at.pop(chat_id, None)
+                start = time.monotonic()
+                await feed(chat_id, text)
+                finished = time.monotonic()
+            except Exception as e:
+                failures[type(e).__name__] += 1
+                return
+        handler_latencies[kind].append(finished - start)
+        started_at[chat_id] = (kind, start)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_scenario(number, kind, text) for number, (kind, text) in enumerate(scenarios)))
+        # Изображения генерируются обработчиками очереди задач уже после завершения обработчика обновления
+        while await main.image_jobs.pending():
+            await asyncio.sleep(0.05)
+        # Ответы могут отправляться в фоне и после завершения обработчика
+        await main.outbound.close(timeout=60)
+        duration = time.perf_counter() - started
+    finally:
+        await main.image_jobs.close()
+        await main.outbound.close()
+        await main.close_http_session()
+        await main.bot.session.close()
+        for server in (telegram, deepinfra, stability):
+            await server.stop()
+
+    for chat_id, (kind, start) in started_at.items():
+        if chat_id in telegram.first_response_at:
+            first_response[kind].append(telegram.first_response_at[chat_id] - start)
+        else:
+            failures["no_response"] += 1
+        if kind == "image" and chat_id in telegram.first_photo_at:
+            first_image.append(telegram.first_photo_at[chat_id] - start)
+
+    report = {
+        "scenarios": len(scenarios),
+        "updates": factory.update_id,
+        "duration_s": round(duration, 2),
+        "throughput_updates_per_s": round(factory.update_id / duration, 1) if duration else 0.0,
+        "import_s": round(import_seconds, 3),
+        "handler_latency_ms": {kind: summarize(values) for kind, values in handler_latencies.items()},
+        "time_to_first_message_ms": {kind: summarize(values) for kind, values in first_response.items()},
+        "time_to_image_ms": summarize(first_image),
+        "image_jobs": main.image_jobs.counts(),
+        "failures": dict(failures),
+        "telegram_calls": dict(telegram.calls),
+        "deepinfra_calls": dict(deepinfra.calls),
+        "deepinfra_models": dict(deepinfra.models),
+        "router_events": {
+            router.route: {"hedged": router.hedged, "failovers": router.failovers}
+            for router in (main.chat_router, main.translate_router)
+        },
+        "stability_calls": dict(stability.calls),
+        "injected_faults": {
+            "telegram": dict(telegram.faults.injected),
+            "deepinfra": dict(deepinfra.faults.injected),
+            "stability": dict(stability.faults.injected),
+        },
+        "upstream_retries": counter_total(main.metric_upstream_retries),
+        "telegram_retries": counter_total(main.metric_telegram_retries),
+        "telegram_failures": counter_total(main.metric_telegram_failures),
+        "coalesced_requests": main.single_flight.saved,
+        "quota_rejections": dict(main.quotas.rejected),
+        # ru_maxrss в Linux измеряется в килобайтах, в macOS - в байтах
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+    if options.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report["tracemalloc_peak_mb"] = round(peak / (1024 * 1024), 1)
+    return report
@@ -0,0 +1,230 @@
+"""Локальные заглушки Telegram Bot API, DeepInfra (OpenAI-совместимый чат) и Stability (text-to-image)"""
+
+import asyncio
+import base64
+import itertools
+import json
+import os
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FaultInjection:
+    """Задержка ответа и искусственные ошибки 429/5xx"""
+
+    def __init__(self, latency=0.05, jitter=0.0, rate_limit_ratio=0.0, error_ratio=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.error_ratio = error_ratio
+        self.retry_after = retry_after
+        self.injected = Counter()
+
+    async def delay(self):
+        """Имитация времени обработки запроса"""
+        latency = self.latency + random.uniform(0, self.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def pick_fault(self):
+        """Выбор ошибки для текущего запроса: 429, 500 или None"""
+        roll = random.random()
+        if roll < self.rate_limit_ratio:
+            self.injected[429] += 1
+            return 429
+        if roll < self.rate_limit_ratio + self.error_ratio:
+            self.injected[500] += 1
+            return 500
+        return None
+
+
+class MockServer:
+    """Базовый класс заглушки: aiohttp-приложение на свободном локальном порту"""
+
+    def __init__(self, faults=None):
+        self.faults = faults or FaultInjection()
+        self.calls = Counter()
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self._runner = None
+        self.base_url = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class MockTelegram(MockServer):
+    """Заглушка Telegram Bot API: отвечает на методы, которые использует бот, и запоминает время ответов по чатам"""
+
+    def __init__(self, faults=None):
+        super().__init__(faults or FaultInjection(latency=0.02))
+        self.first_response_at = {}  # chat_id -> время первого сообщения бота в чат
+        self.last_response_at = {}  # chat_id -> время последнего сообщения бота в чат
+        self.first_photo_at = {}  # chat_id -> время первой отправки изображений в чат
+        self.first_get_updates_at = None
+        self.pending_updates = []  # Обновления, которые вернет getUpdates (для режима polling)
+        self._ids = itertools.count(1)
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def _photo(self):
+        number = next(self._ids)
+        return [{"file_id": f"file{number}", "file_unique_id": f"unique{number}", "width": 1024, "height": 1024}]
+
+    def _record(self, chat_id, photo=False):
+        now = time.monotonic()
+        self.first_response_at.setdefault(chat_id, now)
+        self.last_response_at[chat_id] = now
+        if photo:
+            self.first_photo_at.setdefault(chat_id, now)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        chat_id = int(data.get("chat_id") or 0)
+
+        if method == "getUpdates":
+            if self.first_get_updates_at is None:
+                self.first_get_updates_at = time.monotonic()
+            updates, self.pending_updates = self.pending_updates, []
+            if not updates:
+                await asyncio.sleep(min(float(data.get("timeout") or 0), 0.5))
+            return web.json_response({"ok": True, "result": updates})
+
+        await self.faults.delay()
+        if self.faults.pick_fault() is not None:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.faults.retry_after}",
+                    "parameters": {"retry_after": self.faults.retry_after},
+                },
+                status=429,
+            )
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load test bot", "username": "load_test_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            self._record(chat_id)
+            result = self._message(chat_id, text=data.get("text", ""))
+        elif method == "sendPhoto":
+            self._record(chat_id, photo=True)
+            result = self._message(chat_id, photo=self._photo())
+        elif method == "sendMediaGroup":
+            self._record(chat_id, photo=True)
+            media = json.loads(data.get("media", "[]"))
+            result = [self._message(chat_id, photo=self._photo()) for _ in media]
+        else:
+            # sendChatAction, setWebhook, deleteWebhook и прочие методы без содержательного ответа
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class MockDeepInfra(MockServer):
+    """Заглушка OpenAI-совместимого API DeepInfra с поддержкой потоковых ответов"""
+
+    def __init__(self, faults=None, answer_words=60, token_delay=0.005):
+        super().__init__(faults)
+        self.answer_words = answer_words
+        self.token_delay = token_delay
+        self.models = Counter()  # Запросы по моделям (для проверки маршрутизации)
+        self.app.router.add_post("/v1/openai/chat/completions", self.handle_chat)
+        self.app.router.add_get("/v1/openai/models", self.handle_models)
+
+    async def handle_models(self, request):
+        self.calls["models"] += 1
+        await self.faults.delay()
+        return web.json_response({"object": "list", "data": [{"id": "meta-llama/Meta-Llama-3-8B-Instruct"}]})
+
+    async def handle_chat(self, request):
+        body = await request.json()
+        self.calls["chat"] += 1
+        self.models[body.get("model")] += 1
+        await self.faults.delay()
+        fault = self.faults.pick_fault()
+        if fault == 429:
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": str(self.faults.retry_after)})
+        if fault:
+            return web.json_response({"error": "internal error"}, status=fault)
+
+        words = [f"слово{i}" for i in range(self.answer_words)]
+        usage = {"prompt_tokens": 50, "completion_tokens": len(words), "total_tokens": 50 + len(words)}
+        if not body.get("stream"):
+            # Эхо последнего сообщения, чтобы разные переводы давали разные описания изображений
+            content = body["messages"][-1]["content"] if body.get("messages") else " ".join(words)
+            return web.json_response({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in words:
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class MockStability(MockServer):
+    """Заглушка Stability text-to-image: возвращает случайные байты вместо PNG заданного размера"""
+
+    def __init__(self, faults=None, image_bytes=200_000):
+        super().__init__(faults or FaultInjection(latency=0.5))
+        self.image = os.urandom(image_bytes)
+        self.image_base64 = base64.b64encode(self.image).decode("ascii")
+        self.app.router.add_post("/v1/generation/{engine}/text-to-image", self.handle_generation)
+        self.app.router.add_get("/v1/engines/list", self.handle_engines)
+
+    async def handle_engines(self, request):
+        self.calls["engines"] += 1
+        await self.faults.delay()
+        return web.json_response([{"id": "stable-diffusion-xl-1024-v1-0", "type": "PICTURE"}])
+
+    async def handle_generation(self, request):
+        body = await request.json()
+        self.calls["generation"] += 1
+        await self.faults.delay()
+        fault = self.faults.pick_fault()
+        if fault == 429:
+            return web.json_response({"message": "rate limited"}, status=429, headers={"Retry-After": str(self.faults.retry_after)})
+        if fault:
+            return web.json_response({"message": "internal error"}, status=fault)
+
+        samples = int(body.get("samples", 1))
+        seed = int(body.get("seed", 0)) or random.randint(1, 2 ** 31)
+        if request.headers.get("Accept") == "image/png" and samples == 1:
+            return web.Response(body=self.image, content_type="image/png", headers={"Seed": str(seed), "Finish-Reason": "SUCCESS"})
+        return web.json_response({
+            "artifacts": [
+                {"base64": self.image_base64, "seed": seed + i, "finishReason": "SUCCESS"}
+                for i in range(samples)
+            ]
+        })
@@ -0,0 +1,109 @@
+"""Замер холодного запуска бота: от старта процесса до первого getUpdates и ответа на первое обновление.
+
+Запуск: python -m loadtest.startup --runs 5
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from loadtest.driver import build_environment
+from loadtest.mock_servers import FaultInjection, MockDeepInfra, MockStability, MockTelegram
+
+REPOSITORY_ROOT = Path(__file__).resolve().parents[1]
+
+
+def start_update(update_id, chat_id):
+    """Обновление с командой /start, ответ на которую не зависит от внешних API"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Startup"},
+            "text": "/start",
+        },
+    }
+
+
+async def measure_run(telegram, environment, run_number, timeout):
+    """Один запуск процесса бота; возвращает (до первого getUpdates, до первого ответа) в секундах"""
+    chat_id = 200_000 + run_number
+    telegram.first_get_updates_at = None
+    telegram.pending_updates = [start_update(run_number + 1, chat_id)]
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "main.py",
+        cwd=REPOSITORY_ROOT,
+        env=environment,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        while chat_id not in telegram.first_response_at:
+            if process.returncode is not None:
+                raise RuntimeError(f"Процесс бота завершился с кодом {process.returncode}")
+            if time.monotonic() - started > timeout:
+                raise TimeoutError(f"Бот не ответил за {timeout} сек.")
+            await asyncio.sleep(0.01)
+    finally:
+        # Корректная остановка, как при Ctrl+C
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+    return telegram.first_get_updates_at - started, telegram.first_response_at[chat_id] - started
+
+
+async def run_startup_benchmark(options):
+    telegram = MockTelegram(FaultInjection(latency=options.telegram_latency))
+    deepinfra = MockDeepInfra(FaultInjection(latency=options.preflight_latency))
+    stability = MockStability(FaultInjection(latency=options.preflight_latency))
+    for server in (telegram, deepinfra, stability):
+        await server.start()
+    try:
+        work_dir = tempfile.mkdtemp(prefix="startup-")
+        defaults = SimpleNamespace(stream=True, env=options.env)
+        environment = dict(os.environ, **build_environment(defaults, telegram, deepinfra, stability, work_dir))
+        environment["BOT_MODE"] = "polling"
+        environment["PYTHONUNBUFFERED"] = "1"
+        results = []
+        for run_number in range(options.runs):
+            results.append(await measure_run(telegram, environment, run_number, options.timeout))
+    finally:
+        for server in (telegram, deepinfra, stability):
+            await server.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m loadtest.startup", description="Замер холодного запуска бота")
+    parser.add_argument("--runs", type=int, default=5, help="Число запусков")
+    parser.add_argument("--timeout", type=float, default=60, help="Максимальное ожидание ответа на одном запуске, сек.")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка ответа Bot API, сек.")
+    parser.add_argument("--preflight-latency", type=float, default=2.0,
+                        help="Задержка ответа DeepInfra и Stability (показывает, блокирует ли проверка API запуск), сек.")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Дополнительная настройка бота")
+    options = parser.parse_args(argv)
+
+    results = asyncio.run(run_startup_benchmark(options))
+    for number, (first_poll, first_reply) in enumerate(results, 1):
+        print(f"Запуск {number}: первый getUpdates через {first_poll * 1000:.0f} мс, первый ответ через {first_reply * 1000:.0f} мс")
+    first_polls, first_replies = zip(*results)
+    print(f"Медиана: первый getUpdates {statistics.median(first_polls) * 1000:.0f} мс, "
+          f"первый ответ {statistics.median(first_replies) * 1000:.0f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,36 +4,126 @@ import asyncio
 import aiohttp
 import io
 import base64
+import binascii
 import json
 import time
 import random
+import re
 import sys
-from datetime import datetime
+import hashlib
+import email.utils
+import sqlite3
+import threading
+import bisect
+import heapq
+import contextlib
+import copy
+import atexit
+import queue
+import logging.handlers
+import urllib.parse
+from array import array
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, FSInputFile, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import Message, BufferedInputFile, InputMediaPhoto, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.exceptions import TelegramAPIError
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 # Загрузка переменных окружения
 load_dotenv()
 
 # Настройка логирования
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"bot_{datetime.now().strftime('%Y-%m-%d')}.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text или json
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # Ротация по размеру (0 - отключена)
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))  # Сколько старых файлов хранить
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "true").lower() in ("1", "true", "yes")  # Ротация в полночь
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Файловый обработчик логов с ротацией по размеру и в полночь"""
+    
+    def __init__(self, filename, max_bytes, backup_count, rotate_daily):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.rotate_daily = rotate_daily
+        self.rollover_at = self._next_midnight()
+    
+    @staticmethod
+    def _next_midnight():
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+    
+    def shouldRollover(self, record):
+        if self.rotate_daily and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+    
+    def doRollover(self):
+        # Старые файлы нумеруются: bot.log.1, bot.log.2, ...
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            super().doRollover()
+        self.rollover_at = self._next_midnight()
+
+class JsonFormatter(logging.Formatter):
+    """Форматирование записей лога в виде JSON (одна запись - одна строка)"""
+    
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Передача записей лога в фоновый поток без форматирования в текущем потоке"""
+    
+    def prepare(self, record):
+        # Фиксируем только текст сообщения; форматирование и запись выполняются в фоновом потоке
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging():
+    """Настройка логирования через очередь: запись в файл и консоль выполняется в отдельном потоке"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    # У каждого рабочего процесса свой файл, чтобы процессы не мешали ротации друг друга
+    worker_index = os.getenv("BOT_WORKER_INDEX")
+    if int(os.getenv("BOT_WORKERS", "1")) > 1 and worker_index is not None:
+        log_file = os.path.join(LOG_DIR, f"bot_worker{worker_index}.log")
+    else:
+        log_file = os.path.join(LOG_DIR, "bot.log")
+    
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = SizeAndTimeRotatingFileHandler(log_file, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_DAILY)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Перед выходом дописываем все накопившиеся записи
+    atexit.register(listener.stop)
+    
+    logging.basicConfig(level=logging.INFO, handlers=[BackgroundQueueHandler(log_queue)])
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Получение токенов из переменных окружения
@@ -41,15 +131,29 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "8151093657:AAFWVxK78kJ11eT1MhaO93W
 DEEPINFRA_API_KEY = os.getenv("DEEPINFRA_API_KEY", "sp2xw8vhxJPehPnM0dmLRpX28OCOuoZ9")
 STABILITY_API_KEY = os.getenv("STABILITY_API_KEY", "")  # Добавьте свой ключ Stability AI
 
-# URL для API
-DEEPINFRA_API_URL = "https://api.deepinfra.com/v1/openai/chat/completions"
-STABILITY_TEXT_TO_IMAGE_URL = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+# URL для API (переопределяются, например, для нагрузочного тестирования с локальными заглушками)
+DEEPINFRA_API_URL = os.getenv("DEEPINFRA_API_URL", "https://api.deepinfra.com/v1/openai/chat/completions")
+STABILITY_TEXT_TO_IMAGE_URL = os.getenv(
+    "STABILITY_TEXT_TO_IMAGE_URL",
+    "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+)
+STABILITY_ENGINES_URL = os.getenv(
+    "STABILITY_ENGINES_URL",
+    STABILITY_TEXT_TO_IMAGE_URL.split("/v1/")[0] + "/v1/engines/list"
+)  # Используется для проверки доступности API
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Адрес сервера Bot API (пусто - https://api.telegram.org)
 
-# Заголовки для запросов к API DeepInfra
-deepinfra_headers = {
-    "Authorization": f"Bearer {DEEPINFRA_API_KEY}",
-    "Content-Type": "application/json",
-}
+# Маршрутизация запросов к языковым моделям (OpenAI-совместимые эндпоинты)
+CHAT_MODEL = os.getenv("CHAT_MODEL", "meta-llama/Meta-Llama-3-8B-Instruct")
+TRANSLATE_MODEL = os.getenv("TRANSLATE_MODEL", CHAT_MODEL)  # Для перевода и сжатия истории подойдет небольшая быстрая модель
+# JSON-список бэкендов, например [{"url": "...", "model": "...", "api_key": "...", "weight": 2}]
+# (пусто - один бэкенд DEEPINFRA_API_URL с моделью CHAT_MODEL/TRANSLATE_MODEL)
+CHAT_BACKENDS = os.getenv("CHAT_BACKENDS", "")
+TRANSLATE_BACKENDS = os.getenv("TRANSLATE_BACKENDS", "")
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))  # Вес нового замера в скользящем среднем
+ROUTER_EXPLORE_RATIO = float(os.getenv("ROUTER_EXPLORE_RATIO", "0.05"))  # Доля запросов к случайному бэкенду для обновления статистики
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "false").lower() in ("1", "true", "yes")  # Дублирующий запрос при долгом ответе
+ROUTER_HEDGE_DELAY = float(os.getenv("ROUTER_HEDGE_DELAY", "2"))  # Задержка дублирования, пока не накоплена статистика p95, сек.
 
 # Заголовки для запросов к API Stability
 stability_headers = {
@@ -57,11 +161,18 @@ stability_headers = {
     "Accept": "application/json",
     "Content-Type": "application/json"
 }
+# Для одного изображения Stability возвращает PNG без base64 и JSON
+stability_png_headers = {**stability_headers, "Accept": "image/png"}
 
 # Максимальная длина сообщения в Telegram
 MAX_MESSAGE_LENGTH = 4096
 # Максимальная длина входящего сообщения
 MAX_INPUT_LENGTH = 2000
+# Максимальная длина подписи к фото в Telegram
+MAX_CAPTION_LENGTH = 1024
+# Границы для разбиения длинных сообщений в порядке предпочтения: абзац, строка, предложение, слово
+MESSAGE_BREAKS = ("\n\n", "\n", ". ", "! ", "? ", "… ", "; ", ", ", " ")
+CODE_FENCE_PATTERN = re.compile(r"^```([^\s`]*)", re.MULTILINE)
 
 # Константы для повторных попыток
 MAX_RETRIES = 5
@@ -69,6 +180,136 @@ INITIAL_RETRY_DELAY = 1
 MAX_RETRY_DELAY = 30
 KEEP_ALIVE_INTERVAL = 10 * 60  # 10 минут
 
+# Быстрый запуск: проверка доступности API в фоне после начала получения обновлений
+FAST_START = os.getenv("FAST_START", "true").lower() in ("1", "true", "yes")
+RESTART_DELAY = float(os.getenv("RESTART_DELAY", "1"))  # Пауза перед перезапуском после сбоя (удваивается при повторных сбоях), сек.
+
+# Очередь исходящих запросов к Telegram с ограничением частоты по чатам и для бота в целом
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # Сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))  # Сообщений в один чат, отправляемых без паузы
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "16"))  # Одновременных запросов к Bot API
+CHAT_ACTION_INTERVAL = float(os.getenv("CHAT_ACTION_INTERVAL", "4"))  # Telegram показывает действие ~5 сек., чаще не повторяем
+
+# Режим получения обновлений: polling (long polling) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "32"))  # Число одновременно обрабатываемых обновлений
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))  # Размер очереди обновлений, ожидающих обработки
+
+# Хранилище состояний FSM, общих значений и счетчиков: memory (один процесс) или sqlite (общее для процессов)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "data/state.db")
+# Число рабочих процессов (больше одного - только в режиме webhook с хранилищем sqlite)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_WORKER_INDEX = int(os.getenv("BOT_WORKER_INDEX", "0"))  # Номер текущего рабочего процесса (задается запускающим процессом)
+
+# HTTP-эндпоинт /metrics в формате Prometheus (0 - отключен)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Параметры общего пула HTTP-соединений к внешним API
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))  # Всего соединений
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))  # Соединений на один хост
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # Время жизни DNS-кэша, сек.
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))  # Время жизни простаивающего соединения, сек.
+
+# Потоковая выдача ответов (stream: true) с постепенным редактированием сообщения
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # Не чаще одного редактирования в 1.5 сек. (лимиты Telegram)
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=120, sock_read=30)
+
+# Ограничение числа одновременных запросов к каждому провайдеру
+DEEPINFRA_MAX_CONCURRENCY = int(os.getenv("DEEPINFRA_MAX_CONCURRENCY", "8"))
+STABILITY_MAX_CONCURRENCY = int(os.getenv("STABILITY_MAX_CONCURRENCY", "2"))
+
+# История диалога для каждого чата
+CHAT_HISTORY_ENABLED = os.getenv("CHAT_HISTORY_ENABLED", "true").lower() in ("1", "true", "yes")
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "20"))  # Сообщений в памяти на один чат
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))  # Токенов контекста на запрос (без ответа)
+CHAT_HISTORY_IDLE_TTL = int(os.getenv("CHAT_HISTORY_IDLE_TTL", str(60 * 60)))  # Удаление истории неактивного чата, сек.
+CHAT_HISTORY_MAX_CHATS = int(os.getenv("CHAT_HISTORY_MAX_CHATS", "10000"))  # Максимум чатов с историей в памяти
+CHAT_HISTORY_SUMMARY = os.getenv("CHAT_HISTORY_SUMMARY", "false").lower() in ("1", "true", "yes")  # Фоновое сжатие старых сообщений
+
+# Адаптивное ограничение частоты запросов (запросов в секунду) для каждого вида запросов
+DEEPINFRA_CHAT_RATE_LIMIT = float(os.getenv("DEEPINFRA_CHAT_RATE_LIMIT", "10"))
+DEEPINFRA_TRANSLATE_RATE_LIMIT = float(os.getenv("DEEPINFRA_TRANSLATE_RATE_LIMIT", "10"))
+STABILITY_RATE_LIMIT = float(os.getenv("STABILITY_RATE_LIMIT", "2"))
+RATE_LIMIT_MIN = float(os.getenv("RATE_LIMIT_MIN", "0.2"))  # Нижняя граница частоты после снижений
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", "0.05"))  # Доля максимальной частоты, добавляемая после успешного запроса
+
+# Несколько изображений за один запрос: --n (число вариантов), --seed и --ar (соотношения сторон через запятую)
+IMAGE_MAX_SAMPLES = int(os.getenv("IMAGE_MAX_SAMPLES", "4"))  # Изображений за один вызов Stability
+IMAGE_MAX_IMAGES = min(int(os.getenv("IMAGE_MAX_IMAGES", "4")), 10)  # Всего изображений в ответе (альбом Telegram - до 10)
+# Размеры, поддерживаемые SDXL, для соотношений сторон
+IMAGE_ASPECT_RATIOS = {
+    "1:1": (1024, 1024),
+    "16:9": (1344, 768),
+    "9:16": (768, 1344),
+    "3:2": (1216, 832),
+    "2:3": (832, 1216),
+    "4:3": (1152, 896),
+    "3:4": (896, 1152),
+    "21:9": (1536, 640),
+    "9:21": (640, 1536),
+}
+IMAGE_OPTION_PATTERN = re.compile(r"--(n|seed|ar)\s+([\d:,]+)", re.IGNORECASE)
+# Поле base64 артефакта в JSON-ответе Stability (поиск по байтам без разбора всего ответа)
+ARTIFACT_BASE64_PATTERN = re.compile(rb'"base64"\s*:\s*"([A-Za-z0-9+/=]*)"')
+
+# Очередь задач генерации изображений в SQLite: задачи переживают падение и перезапуск процесса
+IMAGE_JOBS_DB_PATH = os.getenv("IMAGE_JOBS_DB_PATH", "data/jobs.db")  # Пусто - очередь только в памяти
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))  # Задач, выполняемых одновременно (отдельно от обработчиков обновлений)
+IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv("IMAGE_JOB_MAX_ATTEMPTS", "3"))  # Попыток выполнения задачи, включая прерванные падением процесса
+IMAGE_JOB_LEASE = float(os.getenv("IMAGE_JOB_LEASE", "120"))  # Задача без продления аренды дольше этого времени возвращается в очередь, сек.
+IMAGE_JOB_RETENTION = int(os.getenv("IMAGE_JOB_RETENTION", str(7 * 24 * 60 * 60)))  # Хранение завершенных задач, сек.
+
+# Сохранение сгенерированных изображений в папку temp для отладки (по умолчанию изображения не пишутся на диск)
+SAVE_DEBUG_IMAGES = os.getenv("SAVE_DEBUG_IMAGES", "false").lower() in ("1", "true", "yes")
+DEBUG_IMAGES_DIR = "temp"
+
+# Коды ответов, при которых повторять запрос нет смысла
+NON_RETRYABLE_STATUSES = (400, 401, 403)
+
+# Автомат защиты: после серии сбоев провайдера запросы к нему отклоняются сразу, без повторных попыток
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # Сбоев (5xx, ошибки сети) подряд до размыкания
+CIRCUIT_OPEN_TIMEOUT = float(os.getenv("CIRCUIT_OPEN_TIMEOUT", "30"))  # Пауза перед пробным запросом, сек.
+
+# Кэш переводов запросов на генерацию изображений
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "1000"))  # Максимум записей в памяти
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", str(24 * 60 * 60)))  # Время жизни записи, сек. (0 - бессрочно)
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "data/cache.db")  # Путь к файлу SQLite для хранения кэшей между перезапусками (пусто - только в памяти)
+
+# Кэш file_id отправленных изображений для повторной отправки без генерации
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "5000"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(30 * 24 * 60 * 60)))  # 30 дней
+
+# Кэш ответов на частые вопросы (только для сообщений без контекста диалога)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(6 * 60 * 60)))  # 6 часов
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.85"))  # Сходство похожих вопросов (Жаккар по триграммам)
+
+# Квоты пользователей и чатов на платные запросы (0 - без ограничения)
+QUOTAS_ENABLED = os.getenv("QUOTAS_ENABLED", "true").lower() in ("1", "true", "yes")
+QUOTA_REQUESTS = int(os.getenv("QUOTA_REQUESTS", "60"))  # Запросов к моделям за окно QUOTA_REQUESTS_WINDOW
+QUOTA_TOKENS = int(os.getenv("QUOTA_TOKENS", "100000"))  # Токенов DeepInfra за окно QUOTA_TOKENS_WINDOW
+QUOTA_IMAGES = int(os.getenv("QUOTA_IMAGES", "20"))  # Изображений за окно QUOTA_IMAGES_WINDOW
+QUOTA_REQUESTS_WINDOW = int(os.getenv("QUOTA_REQUESTS_WINDOW", str(60 * 60)))  # 1 час
+QUOTA_TOKENS_WINDOW = int(os.getenv("QUOTA_TOKENS_WINDOW", str(24 * 60 * 60)))  # 1 сутки
+QUOTA_IMAGES_WINDOW = int(os.getenv("QUOTA_IMAGES_WINDOW", str(24 * 60 * 60)))  # 1 сутки
+# JSON с дополнительными тарифами, например {"premium": {"requests": 600, "tokens": 1000000, "images": 200}}
+# (встроенные тарифы: default из QUOTA_*, chat - общий лимит группового чата, unlimited - без ограничений)
+QUOTA_TIERS = os.getenv("QUOTA_TIERS", "")
+QUOTA_USER_TIERS = os.getenv("QUOTA_USER_TIERS", "")  # JSON {"id пользователя": "тариф"}
+QUOTA_CHAT_TIER = os.getenv("QUOTA_CHAT_TIER", "chat")  # Тариф общих лимитов групповых чатов
+QUOTA_SNAPSHOT_PATH = os.getenv("QUOTA_SNAPSHOT_PATH", "data/quotas.json")  # Снимок счетчиков для восстановления после перезапуска (пусто - не сохранять; при STORAGE_BACKEND=sqlite счетчики хранятся в общей базе)
+QUOTA_SNAPSHOT_INTERVAL = int(os.getenv("QUOTA_SNAPSHOT_INTERVAL", "60"))  # Период сохранения снимка, сек.
+
 # Определение состояний для FSM
 class BotStates(StatesGroup):
     waiting_for_image_prompt = State()
@@ -83,48 +324,2149 @@ main_keyboard = ReplyKeyboardMarkup(
     one_time_keyboard=False
 )
 
+class LocalStore:
+    """Хранилище значений и счетчиков в памяти текущего процесса"""
+    
+    def __init__(self):
+        self._values = {}
+        self._counters = {}
+    
+    async def get_value(self, key, default=None):
+        return self._values.get(key, default)
+    
+    async def set_value(self, key, value):
+        self._values[key] = value
+    
+    async def incr(self, name, amount=1):
+        self._counters[name] = self._counters.get(name, 0) + amount
+        return self._counters[name]
+    
+    async def get_counters(self):
+        return dict(self._counters)
+    
+    def close(self):
+        pass
+
+class SQLiteStore:
+    """Хранилище значений, счетчиков, состояний FSM, истории диалогов и квот в SQLite, общее для нескольких процессов"""
+    
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}')")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_history ("
+            "id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chat_history_chat ON chat_history (chat_id, id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_memory (chat_id INTEGER PRIMARY KEY, summary TEXT NOT NULL DEFAULT '', last_active REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chat_memory_active ON chat_memory (last_active)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS quota_buckets (counter TEXT NOT NULL, key INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+            "count INTEGER NOT NULL, PRIMARY KEY (counter, key, bucket)) WITHOUT ROWID"
+        )
+        self._db.commit()
+    
+    def _execute(self, sql, params=()):
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self._db.commit()
+            return rows
+    
+    async def execute(self, sql, params=()):
+        """Выполнение запроса в отдельном потоке, чтобы не блокировать цикл событий"""
+        return await asyncio.to_thread(self._execute, sql, params)
+    
+    def query(self, sql, params=()):
+        """Запрос внутри transaction (блокировка уже захвачена потоком транзакции)"""
+        return self._db.execute(sql, params).fetchall()
+    
+    def _transaction(self, function):
+        with self._lock:
+            try:
+                # Блокировка на запись сразу: прочитанное внутри транзакции не изменит другой процесс
+                self._db.execute("BEGIN IMMEDIATE")
+                result = function()
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            return result
+    
+    async def transaction(self, function):
+        """Выполнение function() в одной транзакции в отдельном потоке; запросы внутри нее - через query"""
+        return await asyncio.to_thread(self._transaction, function)
+    
+    async def execute_many(self, statements):
+        """Несколько запросов [(sql, params), ...] в одной транзакции; возвращает строки каждого запроса"""
+        return await self.transaction(lambda: [self.query(sql, params) for sql, params in statements])
+    
+    async def get_value(self, key, default=None):
+        rows = await self.execute("SELECT value FROM kv WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+    
+    async def set_value(self, key, value):
+        await self.execute(
+            "INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value, ensure_ascii=False))
+        )
+    
+    async def incr(self, name, amount=1):
+        rows = await self.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value RETURNING value",
+            (name, amount)
+        )
+        return rows[0][0]
+    
+    async def get_counters(self):
+        return dict(await self.execute("SELECT name, value FROM counters"))
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище состояний FSM aiogram на основе SQLiteStore"""
+    
+    def __init__(self, store):
+        self.store = store
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+    
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self.store.execute(
+            "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (self.key_builder.build(key), state)
+        )
+    
+    async def get_state(self, key):
+        rows = await self.store.execute("SELECT state FROM fsm WHERE key = ?", (self.key_builder.build(key),))
+        return rows[0][0] if rows else None
+    
+    async def set_data(self, key, data):
+        await self.store.execute(
+            "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (self.key_builder.build(key), json.dumps(dict(data), ensure_ascii=False))
+        )
+    
+    async def get_data(self, key):
+        rows = await self.store.execute("SELECT data FROM fsm WHERE key = ?", (self.key_builder.build(key),))
+        return json.loads(rows[0][0]) if rows else {}
+    
+    async def close(self):
+        """Хранилище общее с квотами, историей и счетчиками и закрывается в close_databases, после остановки всех задач"""
+
 # Инициализация бота и диспетчера с хранилищем состояний
-storage = MemoryStorage()
-bot = Bot(token=TELEGRAM_TOKEN)
+if STORAGE_BACKEND == "sqlite":
+    shared_store = SQLiteStore(STATE_DB_PATH)
+    storage = SQLiteStorage(shared_store)
+else:
+    shared_store = LocalStore()
+    storage = MemoryStorage()
+if TELEGRAM_API_URL:
+    bot = Bot(token=TELEGRAM_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher(storage=storage)
 
 # Переменная для отслеживания последней активности
 last_activity_time = time.time()
 
-# Функция для безопасной отправки сообщений с повторными попытками
-async def safe_send_message(chat_id, text, reply_markup=None, retries=3):
-    """Безопасная отправка сообщения с повторными попытками"""
-    for attempt in range(retries):
+# Общая HTTP-сессия для запросов к DeepInfra и Stability (создается в main())
+http_session = None
+
+def create_http_session():
+    """Создание общей HTTP-сессии с пулом соединений"""
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+def get_http_session():
+    """Получение общей HTTP-сессии (создается при первом обращении, если еще не создана)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+async def close_http_session():
+    """Закрытие общей HTTP-сессии"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def escape_label_value(value):
+    """Экранирование значения метки метрики"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labelnames, values, extra=""):
+    """Форматирование меток метрики в формате Prometheus"""
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Счетчик с метками"""
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self._values.items():
+            yield f"{self.name}{format_labels(self.labelnames, key)} {value}"
+
+class Histogram:
+    """Гистограмма длительностей с метками (запись значения - поиск корзины и пара сложений)"""
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [счетчики по корзинам, сумма, количество]
+    
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+    
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Измерение длительности блока кода"""
+        start = time.perf_counter()
         try:
-            await bot.send_message(chat_id, text, reply_markup=reply_markup)
-            return True
-        except TelegramAPIError as e:
-            logger.error(f"Ошибка при отправке сообщения (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(1)
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (bucket_counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{format_labels(self.labelnames, key)} {count}"
+
+class GaugeFunc:
+    """Показатель, значение которого вычисляется только в момент сбора метрик"""
+    
+    def __init__(self, name, documentation, func, labelnames=(), metric_type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.func = func  # Возвращает число или словарь {кортеж меток: значение}
+        self.labelnames = labelnames
+        self.metric_type = metric_type
+    
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield f"{self.name}{format_labels(self.labelnames, key)} {value}"
+
+class MetricsRegistry:
+    """Реестр метрик с выводом в текстовом формате Prometheus"""
+    
+    def __init__(self):
+        self._metrics = []
+        self._refreshers = []  # Корутины, обновляющие значения перед сбором (например, запросы к базе данных в отдельном потоке)
+    
+    def register(self, metric, refresh=None):
+        self._metrics.append(metric)
+        if refresh is not None:
+            self._refreshers.append((metric.name, refresh))
+        return metric
+    
+    async def refresh(self):
+        """Обновление значений, которые нельзя вычислить в цикле событий без блокировки"""
+        for name, refresh in self._refreshers:
+            try:
+                await refresh()
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении метрики {name}: {e}")
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрики {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metric_stage_duration = metrics.register(Histogram(
+    "bot_stage_duration_seconds", "Длительность этапов обработки запросов", ("stage",)
+))
+metric_handler_duration = metrics.register(Histogram(
+    "bot_handler_duration_seconds", "Полное время обработки сообщения обработчиком", ("handler",)
+))
+metric_upstream_duration = metrics.register(Histogram(
+    "bot_upstream_request_duration_seconds", "Длительность одной попытки запроса к внешнему API", ("upstream",)
+))
+metric_upstream_responses = metrics.register(Counter(
+    "bot_upstream_responses_total", "Ответы внешних API по кодам (error - ошибка сети)", ("upstream", "status")
+))
+metric_upstream_retries = metrics.register(Counter(
+    "bot_upstream_retries_total", "Повторные попытки запросов к внешним API", ("upstream",)
+))
+metric_telegram_retries = metrics.register(Counter(
+    "bot_telegram_send_retries_total", "Повторные попытки отправки в Telegram", ("method",)
+))
+metric_telegram_failures = metrics.register(Counter(
+    "bot_telegram_send_failures_total", "Неудачные отправки в Telegram", ("method",)
+))
+
+async def start_metrics_server():
+    """Запуск HTTP-сервера с эндпоинтом /metrics"""
+    from aiohttp import web
+    
+    async def handle_metrics(request):
+        await metrics.refresh()
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    # У каждого рабочего процесса свой порт: METRICS_PORT + номер процесса
+    port = METRICS_PORT + BOT_WORKER_INDEX
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"Метрики доступны по адресу http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+class TTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей, опционально с хранением в SQLite"""
+    
+    def __init__(self, name, max_size, ttl, db_path=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (expires_at, value)
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes_since_prune = 0
+        if db_path:
+            db_dir = os.path.dirname(db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._db.commit()
+    
+    def _expires_at(self):
+        return time.time() + self.ttl if self.ttl else 0
+    
+    def _remember(self, key, value, expires_at):
+        self._items[key] = (expires_at, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+    
+    def _db_get(self, key):
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.name, key)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at and expires_at < time.time():
+            return None
+        return json.loads(value), expires_at
+    
+    def _db_set(self, key, value, expires_at):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.name, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._writes_since_prune += 1
+            # Периодическая очистка устаревших и лишних записей на диске
+            if self._writes_since_prune >= 100:
+                self._writes_since_prune = 0
+                self._db.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND expires_at > 0 AND expires_at < ?",
+                    (self.name, time.time())
+                )
+                self._db.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key NOT IN "
+                    "(SELECT key FROM cache WHERE namespace = ? ORDER BY rowid DESC LIMIT ?)",
+                    (self.name, self.name, self.max_size)
+                )
+            self._db.commit()
+    
+    async def get(self, key):
+        """Получение значения из кэша (None, если записи нет или она устарела)"""
+        value = await self.peek(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    async def peek(self, key):
+        """Получение значения без учета в статистике попаданий и промахов (для предварительных проверок)"""
+        item = self._items.get(key)
+        if item is not None:
+            expires_at, value = item
+            if not expires_at or expires_at >= time.time():
+                self._items.move_to_end(key)
+                return value
+            del self._items[key]
+        if self._db is not None:
+            row = await asyncio.to_thread(self._db_get, key)
+            if row is not None:
+                value, expires_at = row
+                self._remember(key, value, expires_at)
+                return value
+        return None
+    
+    async def set(self, key, value):
+        """Сохранение значения в кэш"""
+        expires_at = self._expires_at()
+        self._remember(key, value, expires_at)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, value, expires_at)
+    
+    def stats(self):
+        """Статистика кэша: размер, попадания, промахи"""
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+    
+    def close(self):
+        """Закрытие соединения с базой данных"""
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+class FairScheduler:
+    """Ограничение числа одновременных запросов к провайдеру со справедливой очередью (по кругу между пользователями)"""
+    
+    def __init__(self, name, max_concurrency):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self._active = 0
+        self._waiting = 0
+        self._queues = {}  # owner -> deque ожидающих futures
+        self._order = deque()  # Очередь владельцев для обхода по кругу
+    
+    def queue_depth(self):
+        """Количество ожидающих запросов"""
+        return self._waiting
+    
+    def _position(self, owner):
+        """Оценка позиции последнего запроса владельца при обходе очереди по кругу"""
+        own_index = len(self._queues[owner])
+        return own_index + sum(
+            min(len(queue), own_index) for other, queue in self._queues.items() if other != owner
+        )
+    
+    def _remove_waiter(self, owner, future):
+        queue = self._queues.get(owner)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self._waiting -= 1
+        if not queue:
+            del self._queues[owner]
+            self._order.remove(owner)
+    
+    async def acquire(self, owner, on_queued=None):
+        """Получение слота; при отсутствии свободных слотов запрос ставится в очередь"""
+        if self._active < self.max_concurrency and not self._waiting:
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        if owner not in self._queues:
+            self._queues[owner] = deque()
+            self._order.append(owner)
+        self._queues[owner].append(future)
+        self._waiting += 1
+        logger.info(f"Запрос к {self.name} поставлен в очередь (ожидают: {self._waiting})")
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued(self._position(owner))
+                except Exception as e:
+                    logger.error(f"Ошибка при уведомлении о позиции в очереди: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже был выделен - возвращаем его
+                self.release()
             else:
-                logger.error(f"Не удалось отправить сообщение после {retries} попыток")
-                return False
+                self._remove_waiter(owner, future)
+            raise
+    
+    def release(self):
+        """Освобождение слота и передача его следующему владельцу по кругу"""
+        self._active -= 1
+        while self._order:
+            owner = self._order.popleft()
+            queue = self._queues[owner]
+            future = queue.popleft()
+            self._waiting -= 1
+            if queue:
+                self._order.append(owner)
+            else:
+                del self._queues[owner]
+            if not future.done():
+                self._active += 1
+                future.set_result(None)
+                return
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, owner, on_queued=None):
+        """Контекстный менеджер для выполнения запроса в выделенном слоте"""
+        await self.acquire(owner, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+# Планировщики запросов к внешним API
+upstream_schedulers = {
+    "deepinfra": FairScheduler("DeepInfra", DEEPINFRA_MAX_CONCURRENCY),
+    "stability": FairScheduler("Stability", STABILITY_MAX_CONCURRENCY),
+}
+
+def parse_retry_after(value):
+    """Разбор заголовка Retry-After (секунды или HTTP-дата), None если разобрать не удалось"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(retry_at.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def parse_reset_interval(value):
+    """Разбор интервала сброса лимита в формате 1.5, 20ms, 6s или 1m30s"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0
+    matches = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not matches:
+        return None
+    for number, unit in matches:
+        total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+class AdaptiveRateLimiter:
+    """Общий для всех запросов ограничитель частоты (token bucket) с адаптацией по сигналам 429 (AIMD)"""
+    
+    def __init__(self, name, max_rate, min_rate=RATE_LIMIT_MIN, increase=RATE_LIMIT_INCREASE):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase = increase * max_rate
+        self.rate = max_rate
+        self._tokens = max(1.0, max_rate)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0
+        self._last_decrease = 0
+    
+    def _refill(self, now):
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    async def acquire(self):
+        """Ожидание разрешения на отправку запроса"""
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def block_for(self, delay):
+        """Приостановка всех запросов на delay секунд"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+    
+    def on_success(self, headers=None):
+        """Аддитивное повышение частоты после успешного запроса"""
+        self.rate = min(self.max_rate, self.rate + self.increase)
+        if headers is not None:
+            remaining = headers.get("x-ratelimit-remaining-requests", headers.get("x-ratelimit-remaining"))
+            reset = parse_reset_interval(headers.get("x-ratelimit-reset-requests", headers.get("x-ratelimit-reset")))
+            if remaining is not None and reset and remaining.strip() == "0":
+                self.block_for(reset)
+    
+    def on_rate_limited(self, retry_after=None):
+        """Мультипликативное снижение частоты после ответа 429"""
+        now = time.monotonic()
+        # Пачка ответов 429 на уже отправленные запросы снижает частоту только один раз
+        if now - self._last_decrease >= 1:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._last_decrease = now
+            logger.warning(f"Частота запросов к {self.name} снижена до {self.rate:.2f} в сек.")
+        if retry_after:
+            self.block_for(retry_after)
+
+# Ограничители частоты запросов к внешним API
+rate_limiters = {
+    "deepinfra_chat": AdaptiveRateLimiter("DeepInfra (чат)", DEEPINFRA_CHAT_RATE_LIMIT),
+    "deepinfra_translate": AdaptiveRateLimiter("DeepInfra (перевод)", DEEPINFRA_TRANSLATE_RATE_LIMIT),
+    "stability": AdaptiveRateLimiter("Stability", STABILITY_RATE_LIMIT),
+}
+
+class UpstreamError(Exception):
+    """Ошибка запроса к внешнему API после применения политики повторных попыток"""
+    
+    def __init__(self, status, text="", retryable=True):
+        super().__init__(f"{status}: {text}")
+        self.status = status
+        self.text = text
+        self.retryable = retryable
+
+class CircuitOpenError(UpstreamError):
+    """Запрос отклонен без обращения к API: провайдер признан недоступным"""
+    
+    def __init__(self, breaker):
+        super().__init__(None, f"{breaker.name} временно недоступен", retryable=False)
+        self.retry_in = breaker.retry_in()
+
+class CircuitBreaker:
+    """Автомат защиты провайдера: closed - запросы идут, open - отклоняются сразу, half_open - идет пробный запрос"""
+    
+    STATES = ("closed", "half_open", "open")
+    
+    def __init__(self, name, probe, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, open_timeout=CIRCUIT_OPEN_TIMEOUT):
+        self.name = name
+        self.probe = probe  # Асинхронная проверка доступности, возвращает True/False
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.state = "closed"
+        self.failures = 0  # Сбоев подряд
+        self.trips = 0  # Сколько раз автомат размыкался
+        self._opened_at = 0
+        self._probe_task = None
+    
+    def check(self):
+        """Исключение CircuitOpenError, если запросы к провайдеру сейчас не выполняются"""
+        if self.state != "closed":
+            raise CircuitOpenError(self)
+    
+    def retry_in(self):
+        """Сколько секунд осталось до следующего пробного запроса"""
+        return max(0, self._opened_at + self.open_timeout - time.monotonic())
+    
+    def record_success(self):
+        self.failures = 0
+        if self.state != "closed":
+            # Успешно завершился запрос, начатый до размыкания
+            self._close()
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "closed" and self.failures >= self.failure_threshold:
+            self._open()
+    
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.trips += 1
+        logger.error(f"{self.name} недоступен ({self.failures} сбоев подряд), запросы отклоняются {self.open_timeout:.0f} сек.")
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_until_closed())
+    
+    def _close(self):
+        self.state = "closed"
+        self.failures = 0
+        logger.info(f"{self.name} снова доступен, запросы возобновлены")
+    
+    async def _probe_until_closed(self):
+        """Периодические пробные запросы, пока провайдер не восстановится"""
+        try:
+            while self.state != "closed":
+                await asyncio.sleep(self.retry_in())
+                self.state = "half_open"
+                try:
+                    available = await self.probe()
+                except Exception as e:
+                    logger.error(f"Ошибка пробного запроса к {self.name}: {e}")
+                    available = False
+                if available:
+                    self._close()
+                elif self.state != "closed":
+                    self.state = "open"
+                    self._opened_at = time.monotonic()
+                    logger.warning(f"{self.name} все еще недоступен, следующая проверка через {self.open_timeout:.0f} сек.")
+        finally:
+            self._probe_task = None
+    
+    def stop(self):
+        """Остановка пробных запросов при завершении работы; автомат замыкается, чтобы перезапущенный main начал с чистого состояния"""
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            # finally задачи может не выполниться, если цикл событий закроется раньше
+            self._probe_task = None
+        self.state = "closed"
+        self.failures = 0
+
+# Автоматы защиты провайдеров; пробный запрос - та же проверка, что и при запуске
+circuit_breakers = {
+    "deepinfra": CircuitBreaker("API DeepInfra", lambda: check_api_availability("deepinfra")),
+    "stability": CircuitBreaker("API Stability", lambda: check_api_availability("stability")),
+}
+
+def retry_backoff(retry_count):
+    """Экспоненциальная задержка перед повторной попыткой со случайной добавкой"""
+    return min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
+
+async def upstream_request(limiter_name, scheduler_name, url, headers, payload, timeout, read_response,
+                           owner=None, on_queued=None, on_rate_limited=None, retries=MAX_RETRIES, observer=None):
+    """Единая политика запросов к внешним API: ограничение частоты, слоты, повторные попытки"""
+    limiter = rate_limiters[limiter_name]
+    scheduler = upstream_schedulers[scheduler_name]
+    breaker = circuit_breakers[scheduler_name]
+    last_status = None
+    for retry_count in range(retries):
+        retry_delay = 0
+        breaker.check()
+        if retry_count:
+            metric_upstream_retries.inc(upstream=limiter_name)
+        await limiter.acquire()
+        started = time.perf_counter()
+        try:
+            async with scheduler.slot(owner, on_queued if retry_count == 0 else None):
+                # Пока запрос ждал слота, провайдер мог быть признан недоступным
+                breaker.check()
+                session = get_http_session()
+                started = time.perf_counter()
+                with metric_upstream_duration.time(upstream=limiter_name):
+                    async with session.post(url, headers=headers, json=payload, timeout=timeout) as response:
+                        last_status = response.status
+                        metric_upstream_responses.inc(upstream=limiter_name, status=response.status)
+                        if observer is not None and response.status != 429:
+                            # Время до получения заголовков ответа (без чтения потокового ответа)
+                            observer.observe(time.perf_counter() - started, response.status == 200)
+                        if response.status == 200:
+                            limiter.on_success(response.headers)
+                            breaker.record_success()
+                            return await read_response(response)
+                        
+                        error_text = await response.text()
+                        if response.status == 429:  # Rate limit
+                            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                            limiter.on_rate_limited(retry_after)
+                            # При наличии Retry-After паузу для всех запросов обеспечивает ограничитель
+                            retry_delay = 0 if retry_after else retry_backoff(retry_count)
+                            wait_time = retry_after or retry_delay
+                            logger.warning(f"Превышен лимит запросов API {limiter.name} (429). Повторная попытка через {wait_time:.2f} сек.")
+                            if on_rate_limited is not None:
+                                await on_rate_limited(wait_time)
+                        else:
+                            logger.error(f"Ошибка API {limiter.name}: {response.status} - {error_text}")
+                            # Для некоторых ошибок нет смысла повторять запрос
+                            if response.status in NON_RETRYABLE_STATUSES:
+                                raise UpstreamError(response.status, error_text, retryable=False)
+                            if response.status >= 500:
+                                breaker.record_failure()
+                            retry_delay = retry_backoff(retry_count)
+                            logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка сети при запросе к {limiter.name}: {str(e)}")
+            metric_upstream_responses.inc(upstream=limiter_name, status="error")
+            if observer is not None:
+                observer.observe(time.perf_counter() - started, False)
+            breaker.record_failure()
+            retry_delay = retry_backoff(retry_count)
+            logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
+        
+        # Пауза перед повторной попыткой выполняется после освобождения слота
+        if retry_delay and retry_count < retries - 1:
+            # Во время сбоя провайдера не держим спящие задачи
+            breaker.check()
+            await asyncio.sleep(retry_delay)
+    
+    raise UpstreamError(last_status, f"Исчерпаны все попытки ({retries})")
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов: выполняется один, результат получают все ожидающие"""
+    
+    def __init__(self):
+        self.saved = 0  # Число сэкономленных запросов к внешним API
+        self._inflight = {}  # key -> задача, выполняющая запрос
+    
+    async def do(self, key, factory):
+        """Выполнение factory() или ожидание уже идущего запроса с тем же ключом"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.saved += 1
+            logger.info(f"Запрос объединен с уже выполняющимся (всего сэкономлено запросов: {self.saved})")
+        # Отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(task)
+    
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Исключение получают ожидающие; если их не осталось, не даем asyncio ругаться на него
+        if not task.cancelled():
+            task.exception()
+
+def request_key(url, payload):
+    """Канонический ключ запроса к внешнему API"""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(f"{url}\n{canonical}".encode("utf-8")).hexdigest()
+
+# Общий реестр выполняющихся запросов к внешним API
+single_flight = SingleFlight()
+
+def register_provider(provider):
+    """Планировщик, автомат защиты и ограничители частоты для провайдера языковых моделей"""
+    if provider not in upstream_schedulers:
+        upstream_schedulers[provider] = FairScheduler(provider, DEEPINFRA_MAX_CONCURRENCY)
+        circuit_breakers[provider] = CircuitBreaker(f"API {provider}", lambda: check_api_availability(provider))
+    for route, max_rate in (("chat", DEEPINFRA_CHAT_RATE_LIMIT), ("translate", DEEPINFRA_TRANSLATE_RATE_LIMIT)):
+        if f"{provider}_{route}" not in rate_limiters:
+            rate_limiters[f"{provider}_{route}"] = AdaptiveRateLimiter(f"{provider} ({route})", max_rate)
+
+class Backend:
+    """OpenAI-совместимый эндпоинт с моделью и скользящей статистикой задержек и ошибок"""
+    
+    def __init__(self, url, model, api_key, weight=1.0, provider=None, name=None):
+        self.url = url
+        self.model = model
+        self.weight = max(float(weight), 0.01)
+        # Провайдер определяет общие для его бэкендов слоты, автомат защиты и лимиты частоты
+        self.provider = provider or ("deepinfra" if url == DEEPINFRA_API_URL else urllib.parse.urlsplit(url).netloc)
+        self.name = name or f"{self.provider}/{model}"
+        self.headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        # Список моделей - дешевая проверка доступности без генерации
+        self.models_url = url[:-len("/chat/completions")] + "/models" if url.endswith("/chat/completions") else None
+        self.latency = None  # EWMA времени ответа, сек.
+        self.error_rate = 0.0  # EWMA доли ошибок
+        self._recent = deque(maxlen=100)  # Последние времена успешных ответов для оценки p95
+    
+    def observe(self, elapsed, ok):
+        """Учет результата запроса (вызывается из upstream_request)"""
+        self.error_rate += ROUTER_EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.latency = elapsed if self.latency is None else self.latency + ROUTER_EWMA_ALPHA * (elapsed - self.latency)
+            self._recent.append(elapsed)
+    
+    def score(self):
+        """Оценка бэкенда для выбора (меньше - лучше); бэкенд без статистики пробуется первым"""
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + 10 * self.error_rate) / self.weight
+    
+    def hedge_delay(self):
+        """Через сколько секунд без ответа отправлять дублирующий запрос (p95 времени ответа)"""
+        if len(self._recent) < 20:
+            return ROUTER_HEDGE_DELAY
+        recent = sorted(self._recent)
+        return recent[int(len(recent) * 0.95) - 1]
+
+def load_backends(config, default_model):
+    """Разбор JSON-списка бэкендов из переменной окружения"""
+    if not config:
+        return [Backend(DEEPINFRA_API_URL, default_model, DEEPINFRA_API_KEY)]
+    backends = []
+    for spec in json.loads(config):
+        backends.append(Backend(
+            spec.get("url", DEEPINFRA_API_URL),
+            spec.get("model", default_model),
+            spec.get("api_key") or os.getenv(spec.get("api_key_env", ""), "") or DEEPINFRA_API_KEY,
+            spec.get("weight", 1.0),
+            spec.get("provider"),
+            spec.get("name")
+        ))
+    return backends
+
+class ModelRouter:
+    """Выбор самого быстрого доступного бэкенда, переключение при сбоях и (по желанию) дублирование медленных запросов"""
+    
+    def __init__(self, route, backends, hedge=ROUTER_HEDGE):
+        self.route = route  # chat или translate: определяет ограничитель частоты
+        self.backends = backends
+        self.hedge = hedge
+        self.hedged = 0  # Отправлено дублирующих запросов
+        self.failovers = 0  # Переключений на другой бэкенд после ошибки
+        for backend in backends:
+            register_provider(backend.provider)
+    
+    def candidates(self):
+        """Бэкенды в порядке предпочтения: сначала доступные, по возрастанию оценки"""
+        ordered = sorted(self.backends, key=lambda backend: (circuit_breakers[backend.provider].state != "closed", backend.score()))
+        if len(ordered) > 1 and random.random() < ROUTER_EXPLORE_RATIO:
+            # Изредка первым идет случайный (с учетом весов) бэкенд, чтобы статистика не устаревала
+            explored = random.choices(ordered, weights=[backend.weight for backend in ordered])[0]
+            ordered.remove(explored)
+            ordered.insert(0, explored)
+        return ordered
+    
+    async def request(self, payload, timeout, read_response, owner=None, on_queued=None, on_rate_limited=None,
+                      retries=MAX_RETRIES, hedge=None):
+        """Запрос к модели через upstream_request; поле model подставляется из выбранного бэкенда.
+        
+        Дублировать можно только запросы, чтение ответа которых не имеет побочных эффектов (не потоковые)
+        """
+        hedge = self.hedge if hedge is None else hedge
+        candidates = self.candidates()
+        # Попытки делятся между бэкендами, чтобы при сбое быстрее переключиться на следующий
+        backend_retries = max(1, -(-retries // len(candidates)))
+        
+        def call(backend, notify=True):
+            return upstream_request(
+                f"{backend.provider}_{self.route}",
+                backend.provider,
+                backend.url,
+                backend.headers,
+                dict(payload, model=backend.model),
+                timeout,
+                read_response,
+                owner=owner,
+                on_queued=on_queued if notify else None,
+                on_rate_limited=on_rate_limited,
+                retries=backend_retries,
+                observer=backend
+            )
+        
+        last_error = None
+        index = 0
+        while index < len(candidates):
+            backend = candidates[index]
+            backup = candidates[index + 1] if hedge and index + 1 < len(candidates) else None
+            try:
+                if backup is not None:
+                    return await self._hedged_request(backend, backup, call)
+                return await call(backend, notify=index == 0)
+            except UpstreamError as e:
+                if not self._can_fail_over(e):
+                    raise
+                last_error = e
+            index += 2 if backup is not None else 1
+            if index < len(candidates):
+                self.failovers += 1
+                logger.warning(f"Бэкенд {backend.name} не ответил ({last_error.status}), переключение на {candidates[index].name}")
+        raise last_error
+    
+    @staticmethod
+    def _can_fail_over(error):
+        """Можно ли повторить запрос на другом бэкенде (некорректный запрос будет отклонен и там)"""
+        return isinstance(error, UpstreamError) and error.status != 400
+    
+    async def _hedged_request(self, primary, backup, call):
+        """Запрос к primary; если ответа нет дольше p95, параллельно запрашивается backup, проигравший отменяется"""
+        tasks = [asyncio.ensure_future(call(primary))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=primary.hedge_delay())
+            if not done:
+                self.hedged += 1
+                logger.info(f"Бэкенд {primary.name} отвечает дольше p95, дублирующий запрос к {backup.name}")
+                tasks.append(asyncio.ensure_future(call(backup, notify=False)))
+            elif not self._can_fail_over(tasks[0].exception()):
+                return tasks[0].result()
+            else:
+                # Быстрая ошибка primary - обычное переключение на backup
+                self.failovers += 1
+                logger.warning(f"Бэкенд {primary.name} не ответил ({tasks[0].exception().status}), переключение на {backup.name}")
+                tasks.append(asyncio.ensure_future(call(backup, notify=False)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+# Маршрутизаторы запросов: ответы в чате и служебные запросы (перевод, сжатие истории)
+chat_router = ModelRouter("chat", load_backends(CHAT_BACKENDS, CHAT_MODEL))
+translate_router = ModelRouter("translate", load_backends(TRANSLATE_BACKENDS, TRANSLATE_MODEL))
+
+metrics.register(GaugeFunc(
+    "bot_upstream_queue_depth", "Запросы, ожидающие слота у провайдера",
+    lambda: {(name,): scheduler.queue_depth() for name, scheduler in upstream_schedulers.items()}, ("provider",)
+))
+metrics.register(GaugeFunc(
+    "bot_upstream_rate_limit", "Текущая разрешенная частота запросов, в сек.",
+    lambda: {(name,): limiter.rate for name, limiter in rate_limiters.items()}, ("upstream",)
+))
+metrics.register(GaugeFunc(
+    "bot_circuit_state", "Состояние автомата защиты провайдера (0 - closed, 1 - half_open, 2 - open)",
+    lambda: {(name,): CircuitBreaker.STATES.index(breaker.state) for name, breaker in circuit_breakers.items()}, ("provider",)
+))
+metrics.register(GaugeFunc(
+    "bot_circuit_trips_total", "Сколько раз провайдер признавался недоступным",
+    lambda: {(name,): breaker.trips for name, breaker in circuit_breakers.items()}, ("provider",),
+    metric_type="counter"
+))
+metrics.register(GaugeFunc(
+    "bot_backend_latency_seconds", "Скользящее среднее времени ответа бэкенда языковой модели",
+    lambda: {
+        (router.route, backend.name): backend.latency
+        for router in (chat_router, translate_router) for backend in router.backends if backend.latency is not None
+    },
+    ("route", "backend")
+))
+metrics.register(GaugeFunc(
+    "bot_backend_error_rate", "Скользящая доля ошибок бэкенда языковой модели",
+    lambda: {
+        (router.route, backend.name): backend.error_rate
+        for router in (chat_router, translate_router) for backend in router.backends
+    },
+    ("route", "backend")
+))
+metrics.register(GaugeFunc(
+    "bot_router_events_total", "Дублирующие запросы и переключения между бэкендами",
+    lambda: {
+        (router.route, event): getattr(router, event)
+        for router in (chat_router, translate_router) for event in ("hedged", "failovers")
+    },
+    ("route", "event"),
+    metric_type="counter"
+))
+metrics.register(GaugeFunc(
+    "bot_coalesced_requests_total", "Запросы, объединенные с уже выполняющимися", lambda: single_flight.saved,
+    metric_type="counter"
+))
+metrics.register(GaugeFunc(
+    "bot_cache_events_total", "Попадания и промахи кэшей",
+    lambda: {
+        (cache.name, event): cache.stats()[event]
+        for cache in (translation_cache, image_cache, response_cache.answers) for event in ("hits", "misses")
+    },
+    ("cache", "event"),
+    metric_type="counter"
+))
+
+metrics.register(GaugeFunc(
+    "bot_response_cache_near_hits_total", "Ответы из кэша на похожие (не совпадающие дословно) вопросы",
+    lambda: response_cache.near_hits, metric_type="counter"
+))
+
+def queue_notifier(chat_id):
+    """Создание функции уведомления пользователя о позиции в очереди"""
+    async def notify(position):
+        await safe_send_message(
+            chat_id,
+            f"Сейчас много запросов. Ваш запрос в очереди, позиция: {position}. Пожалуйста, подождите...",
+            wait=False
+        )
+    return notify
+
+def is_english(text):
+    """Быстрая локальная проверка, что текст уже на английском: все буквы латинские (ASCII)"""
+    letters = [char for char in text if char.isalpha()]
+    return bool(letters) and all(char.isascii() for char in letters)
+
+def normalize_prompt(text):
+    """Нормализация текста запроса для использования в качестве ключа кэша"""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+# Кэш переводов: нормализованный запрос -> перевод
+translation_cache = TTLCache("translation", TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL, CACHE_DB_PATH or None)
+
+# Кэш изображений: параметры генерации -> список file_id в Telegram
+image_cache = TTLCache("image_file_id", IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL, CACHE_DB_PATH or None)
+
+def image_cache_key(data):
+    """Ключ кэша изображений по параметрам генерации, влияющим на результат"""
+    key_fields = {
+        "prompt": normalize_prompt(data["text_prompts"][0]["text"]),
+        "cfg_scale": data["cfg_scale"],
+        "steps": data["steps"],
+        "width": data["width"],
+        "height": data["height"],
+        "samples": data["samples"],
+        "seed": data.get("seed", 0),
+    }
+    return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ImageJobDeferred(Exception):
+    """Задачу нужно выполнить позже (например, пока автомат защиты провайдера разомкнут)"""
+    
+    def __init__(self, delay):
+        super().__init__(f"Задача отложена на {delay:.0f} сек.")
+        self.delay = delay
+
+class ImageJob:
+    """Задача генерации изображения из очереди"""
+    
+    def __init__(self, job_id, chat_id, user_id, prompt, options, attempts, status_message_id):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.options = options  # Параметры из parse_image_options и учтенная квота изображений ("quota")
+        self.attempts = attempts  # Включая текущую попытку
+        self.status_message_id = status_message_id  # Сообщение о ходе генерации (None, если не отправлено)
+        self.generated = 0  # Сгенерировано и доставлено новых изображений
+
+class ImageJobQueue:
+    """Очередь задач генерации изображений в SQLite (WAL) с пулом асинхронных обработчиков.
+    
+    Задача отмечается выполненной только после доставки результата пользователю. Задачи, прерванные падением
+    процесса, возвращаются в очередь при следующем запуске или по истечении аренды (при нескольких процессах)
+    """
+    
+    STATUSES = ("queued", "running", "delivered", "failed")
+    POLL_INTERVAL = 1  # Проверка задач, поставленных другими процессами или отложенных, сек.
+    
+    def __init__(self, db_path, workers, lease, retention):
+        if db_path:
+            db_dir = os.path.dirname(db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+        self.workers = workers
+        self.lease = lease
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path or ":memory:", check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS image_jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+            "prompt TEXT NOT NULL, options TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', "
+            "attempts INTEGER NOT NULL DEFAULT 0, owner INTEGER, run_at REAL NOT NULL, lease_until REAL, "
+            "error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, status_message_id INTEGER)"
+        )
+        with contextlib.suppress(sqlite3.OperationalError):
+            # Столбец добавлен позже: базы, созданные предыдущей версией, дополняются
+            self._db.execute("ALTER TABLE image_jobs ADD COLUMN status_message_id INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS image_jobs_status ON image_jobs (status, run_at)")
+        self._db.commit()
+        self._handler = None
+        self._tasks = []
+        self._wakeup = None
+        self._closing = False
+        self.last_counts = dict.fromkeys(self.STATUSES, 0)  # Число задач по статусам на момент последнего сбора метрик
+    
+    def _execute(self, sql, params=()):
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self._db.commit()
+            return rows
+    
+    async def execute(self, sql, params=()):
+        return await asyncio.to_thread(self._execute, sql, params)
+    
+    async def enqueue(self, chat_id, user_id, prompt, options, status_message_id=None):
+        """Сохранение задачи; возвращает id задачи"""
+        now = time.time()
+        rows = await self.execute(
+            "INSERT INTO image_jobs (chat_id, user_id, prompt, options, status_message_id, run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id",
+            (chat_id, user_id, prompt, json.dumps(options), status_message_id, now, now, now)
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return rows[0][0]
+    
+    async def pending(self):
+        """Число задач в очереди и в работе"""
+        rows = await self.execute("SELECT COUNT(*) FROM image_jobs WHERE status IN ('queued', 'running')")
+        return rows[0][0]
+    
+    def _claim(self):
+        now = time.time()
+        # Выбор и захват задачи одним запросом: несколько процессов не получат одну задачу
+        rows = self._execute(
+            "UPDATE image_jobs SET status = 'running', attempts = attempts + 1, owner = ?, lease_until = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM image_jobs WHERE status = 'queued' AND run_at <= ? ORDER BY run_at, id LIMIT 1) "
+            "RETURNING id, chat_id, user_id, prompt, options, attempts, status_message_id",
+            (BOT_WORKER_INDEX, now + self.lease, now, now)
+        )
+        if not rows:
+            return None
+        job_id, chat_id, user_id, prompt, options, attempts, status_message_id = rows[0]
+        return ImageJob(job_id, chat_id, user_id, prompt, json.loads(options), attempts, status_message_id)
+    
+    def _finish(self, job, status, error=None, delay=0):
+        now = time.time()
+        self._execute(
+            "UPDATE image_jobs SET status = ?, error = ?, run_at = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+            (status, error, now + delay, now, job.id)
+        )
+    
+    def _recover(self, owner=None):
+        """Возврат в очередь задач, брошенных упавшим процессом, и удаление старых завершенных задач"""
+        now = time.time()
+        rows = self._execute(
+            "UPDATE image_jobs SET status = 'queued', lease_until = NULL, updated_at = ? "
+            "WHERE status = 'running' AND (owner = ? OR lease_until < ?) RETURNING id",
+            (now, owner, now)
+        )
+        self._execute(
+            "DELETE FROM image_jobs WHERE status IN ('delivered', 'failed') AND updated_at < ?",
+            (now - self.retention,)
+        )
+        return len(rows)
+    
+    def counts(self):
+        """Число задач по статусам"""
+        counts = dict.fromkeys(self.STATUSES, 0)
+        counts.update(self._execute("SELECT status, COUNT(*) FROM image_jobs GROUP BY status"))
+        return counts
+    
+    async def refresh_counts(self):
+        """Обновление last_counts в отдельном потоке: запрос может ждать блокировку базы, занятую другими процессами"""
+        self.last_counts = await asyncio.to_thread(self.counts)
+    
+    def start(self, handler):
+        """Запуск обработчиков; handler(job) возвращает True, если результат доставлен, и False при отказе"""
+        if self._tasks:
+            return
+        self._handler = handler
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        # Задачи, которые выполнял предыдущий экземпляр этого процесса, возвращаются в очередь до запуска обработчиков:
+        # иначе задачу, захваченную новым обработчиком, можно вернуть в очередь и выполнить второй раз
+        try:
+            recovered = self._recover(BOT_WORKER_INDEX)
+            if recovered:
+                logger.warning(f"Возвращено в очередь прерванных задач генерации изображений: {recovered}")
+        except Exception as e:
+            logger.error(f"Ошибка при восстановлении очереди задач генерации изображений: {e}")
+        self._tasks = [asyncio.create_task(self._maintain())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def _maintain(self):
+        # Возврат задач с истекшей арендой (упал другой процесс) и удаление старых завершенных задач
+        while True:
+            await asyncio.sleep(self.lease / 2)
+            try:
+                recovered = await asyncio.to_thread(self._recover)
+                if recovered:
+                    logger.warning(f"Возвращено в очередь прерванных задач генерации изображений: {recovered}")
+                    self._wakeup.set()
+            except Exception as e:
+                logger.error(f"Ошибка при обслуживании очереди задач генерации изображений: {e}")
+    
+    async def _worker(self):
+        while not self._closing:
+            try:
+                job = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                logger.error(f"Ошибка при получении задачи генерации изображения: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            await self._run(job)
+    
+    async def _run(self, job):
+        task = asyncio.create_task(self._handler(job))
+        try:
+            # Аренда продлевается, пока задача выполняется
+            while not (await asyncio.wait({task}, timeout=self.lease / 3))[0]:
+                await self.execute("UPDATE image_jobs SET lease_until = ? WHERE id = ?", (time.time() + self.lease, job.id))
+            delivered = task.result()
+        except asyncio.CancelledError:
+            task.cancel()
+            # Остановка процесса: задача вернется в очередь без учета прерванной попытки
+            self._execute(
+                "UPDATE image_jobs SET status = 'queued', attempts = attempts - 1, lease_until = NULL WHERE id = ?", (job.id,)
+            )
+            raise
+        except ImageJobDeferred as e:
+            logger.info(f"Задача генерации изображения {job.id} отложена на {e.delay:.0f} сек.")
+            await asyncio.to_thread(self._finish, job, "queued", str(e), e.delay)
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при отправке сообщения: {e}")
-            return False
+            logger.error(f"Ошибка при выполнении задачи генерации изображения {job.id}: {e}")
+            await asyncio.to_thread(self._finish, job, "failed", str(e))
+        else:
+            await asyncio.to_thread(self._finish, job, "delivered" if delivered else "failed")
+    
+    async def close(self, timeout=5):
+        """Ожидание выполняемых задач (не дольше timeout сек.) и остановка обработчиков; незавершенные задачи остаются в очереди"""
+        if not self._tasks:
+            return
+        self._closing = True
+        self._wakeup.set()
+        maintain, workers = self._tasks[0], self._tasks[1:]
+        maintain.cancel()
+        _, running = await asyncio.wait(workers, timeout=timeout)
+        if running:
+            logger.warning(f"Задачи генерации изображений, прерванные остановкой: {len(running)}")
+            for worker in running:
+                worker.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+        self._tasks = []
+    
+    def close_db(self):
+        with self._lock:
+            self._db.close()
+
+# Очередь задач генерации изображений (обработчики запускаются в main())
+image_jobs = ImageJobQueue(IMAGE_JOBS_DB_PATH, IMAGE_WORKERS, IMAGE_JOB_LEASE, IMAGE_JOB_RETENTION)
+
+@dp.shutdown()
+async def stop_image_jobs():
+    """Завершение выполняемых задач до остановки очереди исходящих сообщений"""
+    await image_jobs.close()
+
+metrics.register(GaugeFunc(
+    "bot_image_jobs", "Задачи генерации изображений по статусам",
+    lambda: {(status,): count for status, count in image_jobs.last_counts.items()}, ("status",)
+), refresh=image_jobs.refresh_counts)
+
+class OutboundJob:
+    """Запрос к Bot API в очереди исходящих сообщений"""
+    
+    def __init__(self, method, call, priority, retries, future):
+        self.method = method  # Название метода для логов и метрик
+        self.call = call  # Функция без аргументов, возвращающая корутину запроса
+        self.priority = priority
+        self.retries = retries
+        self.future = future
+        self.attempts = 0
 
-# Функция для безопасной отправки действия чата с повторными попытками
-async def safe_send_chat_action(chat_id, action, retries=3):
-    """Безопасная отправка действия чата с повторными попытками"""
-    for attempt in range(retries):
+class ChatOutbox:
+    """Очередь исходящих запросов и ограничение частоты (token bucket) для одного чата"""
+    
+    def __init__(self, burst):
+        self.jobs = []  # Куча (приоритет, порядковый номер, запрос)
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0  # Пауза после flood wait или ошибки
+        self.busy = False  # Чат ожидает обработчика или запрос уже выполняется
+        self.pending_action = None  # Действие чата, ожидающее отправки
+        self.pending_edits = {}  # message_id -> (новый текст, future) для правок, ожидающих отправки
+        self.last_action = None  # (действие, время отправки)
+
+class OutboundDispatcher:
+    """Общая очередь исходящих запросов к Bot API: приоритеты, лимиты частоты по чатам и в целом, соблюдение flood wait.
+    
+    Запросы одного чата выполняются строго по очереди, поэтому части длинного ответа не перемешиваются
+    """
+    
+    PRIORITY_MESSAGE = 0  # Сообщения, которых ждет пользователь
+    PRIORITY_EDIT = 1  # Промежуточные правки потокового ответа
+    PRIORITY_ACTION = 2  # Индикаторы "печатает..." (не расходуют лимит чата)
+    
+    def __init__(self, global_rate, chat_rate, chat_burst, concurrency):
+        self.limiter = AdaptiveRateLimiter("Telegram", global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.coalesced = {"action": 0, "edit": 0}  # Действия и правки, объединенные с ожидающими или недавними
+        self._chats = {}  # chat_id -> ChatOutbox
+        self._ready = None  # Чаты, готовые к отправке: (приоритет, порядковый номер, chat_id)
+        self._workers = []
+        self._sequence = 0
+        self._pending = 0  # Запросы в очереди и в работе
+        self._idle = None
+    
+    def _start(self):
+        if not self._workers:
+            self._ready = asyncio.PriorityQueue()
+            self._idle = asyncio.Event()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+    
+    def pending(self):
+        return self._pending
+    
+    def _outbox(self, chat_id):
+        outbox = self._chats.get(chat_id)
+        if outbox is None:
+            outbox = self._chats[chat_id] = ChatOutbox(self.chat_burst)
+        return outbox
+    
+    def submit(self, chat_id, method, call, priority=PRIORITY_MESSAGE, retries=3, background=False):
+        """Постановка запроса в очередь; возвращает future с результатом (исключение - после всех попыток)"""
+        return self._submit(chat_id, method, call, priority, retries, background).future
+    
+    def _submit(self, chat_id, method, call, priority, retries, background):
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        if background:
+            # Ошибку уже записал обработчик очереди, результат никто не ждет
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        job = OutboundJob(method, call, priority, retries, future)
+        outbox = self._outbox(chat_id)
+        self._sequence += 1
+        heapq.heappush(outbox.jobs, (priority, self._sequence, job))
+        self._pending += 1
+        self._idle.clear()
+        self._schedule(chat_id, outbox)
+        return job
+    
+    def send_chat_action(self, chat_id, action):
+        """Действие чата в фоне: повтор того же действия в пределах CHAT_ACTION_INTERVAL и дубли в очереди отбрасываются"""
+        self._start()
+        outbox = self._outbox(chat_id)
+        recent = outbox.last_action and outbox.last_action[0] == action and time.monotonic() - outbox.last_action[1] < CHAT_ACTION_INTERVAL
+        if outbox.pending_action is not None or recent:
+            if outbox.pending_action is not None:
+                outbox.pending_action = action
+            self.coalesced["action"] += 1
+            return
+        
+        async def send_pending_action():
+            pending_action, outbox.pending_action = outbox.pending_action, None
+            if pending_action is None:
+                # Действие отменено отправленным сообщением
+                return True
+            outbox.last_action = (pending_action, time.monotonic())
+            return await bot.send_chat_action(chat_id, pending_action)
+        
+        outbox.pending_action = action
+        self.submit(chat_id, "send_chat_action", send_pending_action, self.PRIORITY_ACTION, background=True)
+    
+    def edit_message_text(self, chat_id, message_id, text, retries=3, background=False):
+        """Правка сообщения; возвращает future с текстом, который показан после правки.
+        
+        Если правка того же сообщения еще в очереди, в ней просто заменяется текст, а число попыток
+        увеличивается до большего из запрошенных: итоговую правку нельзя потерять из-за промежуточной
+        """
+        outbox = self._outbox(chat_id)
+        pending = outbox.pending_edits.get(message_id)
+        if pending is not None:
+            job = pending[1]
+            job.retries = max(job.retries, retries)
+            outbox.pending_edits[message_id] = (text, job)
+            self.coalesced["edit"] += 1
+            return job.future
+        
+        sent_text = text
+        
+        async def edit():
+            nonlocal sent_text
+            pending = outbox.pending_edits.get(message_id)
+            if pending is not None and pending[1] is job:
+                # Последний текст забирается из очереди; следующие правки станут новым запросом,
+                # а повторная попытка после ошибки отправит тот же текст
+                sent_text = pending[0]
+                del outbox.pending_edits[message_id]
+            try:
+                await bot.edit_message_text(sent_text, chat_id=chat_id, message_id=message_id)
+            except TelegramBadRequest as e:
+                # Текст не изменился - это не ошибка
+                if "message is not modified" not in str(e):
+                    raise
+            return sent_text
+        
+        job = self._submit(chat_id, "edit_message_text", edit, self.PRIORITY_EDIT, retries, background)
+        outbox.pending_edits[message_id] = (text, job)
+        return job.future
+    
+    def _delay(self, outbox, job, now):
+        """Через сколько секунд запрос можно отправить с учетом паузы и лимита чата"""
+        delay = outbox.blocked_until - now
+        if job.priority != self.PRIORITY_ACTION:
+            outbox.tokens = min(self.chat_burst, outbox.tokens + (now - outbox.updated_at) * self.chat_rate)
+            outbox.updated_at = now
+            if outbox.tokens < 1:
+                delay = max(delay, (1 - outbox.tokens) / self.chat_rate)
+        return delay
+    
+    def _schedule(self, chat_id, outbox):
+        """Передача чата обработчикам, когда его первый запрос можно отправить"""
+        if outbox.busy:
+            return
+        if not outbox.jobs:
+            # Состояние чата нужно, пока не восстановился лимит и не истек интервал действий
+            asyncio.get_running_loop().call_later(CHAT_ACTION_INTERVAL, self._forget, chat_id, outbox)
+            return
+        outbox.busy = True
+        priority, sequence, job = outbox.jobs[0]
+        delay = self._delay(outbox, job, time.monotonic())
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, (priority, sequence, chat_id))
+        else:
+            self._ready.put_nowait((priority, sequence, chat_id))
+    
+    def _forget(self, chat_id, outbox):
+        if not outbox.busy and not outbox.jobs and self._chats.get(chat_id) is outbox:
+            del self._chats[chat_id]
+    
+    async def _worker(self):
+        while True:
+            _, _, chat_id = await self._ready.get()
+            outbox = self._chats[chat_id]
+            priority, sequence, job = outbox.jobs[0]
+            # Пока чат ждал, в его очередь мог попасть более срочный запрос или прийти flood wait
+            delay = self._delay(outbox, job, time.monotonic())
+            if delay > 0:
+                asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, (priority, sequence, chat_id))
+                continue
+            heapq.heappop(outbox.jobs)
+            if job.priority != self.PRIORITY_ACTION:
+                outbox.tokens -= 1
+            await self.limiter.acquire()
+            try:
+                await self._execute(chat_id, outbox, sequence, job)
+            finally:
+                outbox.busy = False
+                self._schedule(chat_id, outbox)
+    
+    async def _execute(self, chat_id, outbox, sequence, job):
+        """Выполнение запроса; при ошибке запрос возвращается в начало очереди чата"""
+        job.attempts += 1
         try:
-            await bot.send_chat_action(chat_id, action)
-            return True
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            outbox.blocked_until = time.monotonic() + e.retry_after
+            logger.warning(f"Превышен лимит Telegram в чате {chat_id} ({job.method}), пауза {e.retry_after} сек.")
+            error = e
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            # Повтор не поможет: неверный запрос или бот заблокирован пользователем
+            job.attempts = job.retries
+            error = e
         except TelegramAPIError as e:
-            logger.error(f"Ошибка при отправке действия чата (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(1)
-            else:
-                return False
+            outbox.blocked_until = time.monotonic() + 1
+            error = e
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка при вызове {job.method}: {e}")
+            job.attempts = job.retries
+            error = e
+        else:
+            if job.method != "send_chat_action":
+                # Отправленное сообщение сбрасывает индикатор действия в Telegram
+                outbox.pending_action = None
+                outbox.last_action = None
+            self._finish(job, result)
+            return
+        
+        if job.attempts < job.retries:
+            logger.error(f"Ошибка Telegram API при вызове {job.method} (попытка {job.attempts}/{job.retries}): {error}")
+            metric_telegram_retries.inc(method=job.method)
+            heapq.heappush(outbox.jobs, (job.priority, sequence, job))
+        else:
+            logger.error(f"Не удалось выполнить {job.method} в чате {chat_id} после {job.attempts} попыток: {error}")
+            metric_telegram_failures.inc(method=job.method)
+            self._finish(job, error=error)
+    
+    def _finish(self, job, result=None, error=None):
+        self._pending -= 1
+        if not self._pending:
+            self._idle.set()
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+    
+    async def close(self, timeout=5):
+        """Отправка оставшихся запросов (не дольше timeout сек.) и остановка обработчиков"""
+        if not self._workers:
+            return
+        if self._pending:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не отправлено запросов к Telegram при остановке: {self._pending}")
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+# Общая очередь исходящих запросов к Telegram
+outbound = OutboundDispatcher(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_SEND_CONCURRENCY)
+
+@dp.shutdown()
+async def stop_outbound_dispatcher():
+    """Отправка оставшихся сообщений до закрытия сессии бота"""
+    await outbound.close()
+
+metrics.register(GaugeFunc(
+    "bot_telegram_outbound_pending", "Запросы к Telegram в очереди и в работе", outbound.pending
+))
+metrics.register(GaugeFunc(
+    "bot_telegram_coalesced_total", "Действия чата и правки сообщений, объединенные с недавними или ожидающими",
+    lambda: {(kind,): count for kind, count in outbound.coalesced.items()}, ("kind",),
+    metric_type="counter"
+))
+
+def char_ngrams(text, n=3):
+    """Множество символьных n-грамм текста"""
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def simhash(grams):
+    """64-битный SimHash множества n-грамм: у похожих текстов отличается мало битов"""
+    weights = [0] * 64
+    for gram in grams:
+        value = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+class ResponseCache:
+    """Кэш ответов: точное совпадение нормализованного вопроса, затем поиск похожего вопроса по SimHash"""
+    
+    BANDS = 8  # Отпечаток делится на 8 частей по 8 бит: отпечатки, отличающиеся не более чем в 7 битах, совпадут хотя бы в одной части
+    
+    def __init__(self, max_size, ttl, threshold, db_path=None):
+        self.answers = TTLCache("response", max_size, ttl, db_path)
+        self.max_size = max_size
+        self.threshold = threshold
+        self.near_hits = 0
+        self._fingerprints = OrderedDict()  # нормализованный вопрос -> SimHash
+        self._bands = [{} for _ in range(self.BANDS)]  # номер части -> {значение части: множество вопросов}
+    
+    @staticmethod
+    def _normalize(text):
+        """Ключ вопроса: без регистра, пунктуации и лишних пробелов"""
+        return normalize_prompt(re.sub(r"[^\w\s+\-*/=]", " ", text))
+    
+    @classmethod
+    def _split(cls, fingerprint):
+        return [(fingerprint >> (8 * i)) & 0xFF for i in range(cls.BANDS)]
+    
+    def _index(self, key):
+        if key in self._fingerprints:
+            self._fingerprints.move_to_end(key)
+            return
+        fingerprint = simhash(char_ngrams(key))
+        self._fingerprints[key] = fingerprint
+        for band, value in zip(self._bands, self._split(fingerprint)):
+            band.setdefault(value, set()).add(key)
+        while len(self._fingerprints) > self.max_size:
+            self._forget(next(iter(self._fingerprints)))
+    
+    def _forget(self, key):
+        fingerprint = self._fingerprints.pop(key, None)
+        if fingerprint is None:
+            return
+        for band, value in zip(self._bands, self._split(fingerprint)):
+            keys = band.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del band[value]
+    
+    def _find_similar(self, key):
+        """Самый похожий из сохраненных вопросов (None, если сходство ниже порога)"""
+        grams = char_ngrams(key)
+        fingerprint = simhash(grams)
+        numbers = re.findall(r"\d+", key)
+        candidates = set()
+        for band, value in zip(self._bands, self._split(fingerprint)):
+            candidates |= band.get(value, set())
+        best, best_score = None, self.threshold
+        for candidate in candidates:
+            if (fingerprint ^ self._fingerprints[candidate]).bit_count() >= self.BANDS:
+                continue
+            # Вопросы, отличающиеся числами ("2+2" и "2+3"), похожи по тексту, но ответы у них разные
+            if re.findall(r"\d+", candidate) != numbers:
+                continue
+            other = char_ngrams(candidate)
+            score = len(grams & other) / len(grams | other)
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+    
+    async def get(self, text):
+        """Ответ на тот же или похожий вопрос (None, если его нет)"""
+        key = self._normalize(text)
+        answer = await self.answers.get(key)
+        if answer is not None:
+            return answer
+        similar = self._find_similar(key)
+        if similar is None:
+            return None
+        answer = await self.answers.get(similar)
+        if answer is None:
+            # Запись уже вытеснена из кэша или устарела
+            self._forget(similar)
+            return None
+        self.near_hits += 1
+        return answer
+    
+    async def set(self, text, answer):
+        """Сохранение ответа на вопрос"""
+        key = self._normalize(text)
+        await self.answers.set(key, answer)
+        self._index(key)
+    
+    def close(self):
+        self.answers.close()
+
+# Кэш ответов на частые вопросы
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_THRESHOLD, CACHE_DB_PATH or None)
+
+class SlidingWindowCounter:
+    """Счетчики в скользящем окне: окно делится на корзины, для каждого ключа хранится кольцевой массив сумм"""
+    
+    def __init__(self, window, buckets=60):
+        self.window = window
+        self.buckets = buckets
+        self.bucket_seconds = window / buckets
+        self._counters = {}  # key -> [номер последней корзины, array('q') сумм по корзинам]
+    
+    def _slots(self, key, now, create=False):
+        current = int(now // self.bucket_seconds)
+        entry = self._counters.get(key)
+        if entry is None:
+            if not create:
+                return None, current
+            entry = self._counters[key] = [current, array("q", bytes(8 * self.buckets))]
+        last, counts = entry
+        if current - last >= self.buckets:
+            # Все корзины устарели
+            counts[:] = array("q", bytes(8 * self.buckets))
+        else:
+            for bucket in range(last + 1, current + 1):
+                counts[bucket % self.buckets] = 0
+        entry[0] = max(last, current)
+        return counts, current
+    
+    def add(self, key, amount, now=None):
+        counts, current = self._slots(key, time.time() if now is None else now, create=True)
+        counts[current % self.buckets] += amount
+    
+    def refund(self, key, amount, charged_at, now=None):
+        """Вычитание из корзины, в которую amount учтено в момент charged_at, если она еще в окне (не ниже нуля)"""
+        counts, current = self._slots(key, time.time() if now is None else now)
+        charged = int(charged_at // self.bucket_seconds)
+        # Корзина старше окна уже переиспользована для более нового периода
+        if counts is not None and 0 <= current - charged < self.buckets:
+            index = charged % self.buckets
+            counts[index] = max(counts[index] - amount, 0)
+    
+    def total(self, key, now=None):
+        counts, _ = self._slots(key, time.time() if now is None else now)
+        return sum(counts) if counts is not None else 0
+    
+    def retry_in(self, key, excess, now=None):
+        """Через сколько секунд из окна выйдет не меньше excess единиц"""
+        now = time.time() if now is None else now
+        counts, current = self._slots(key, now)
+        if counts is None:
+            return 0
+        released = 0
+        # Корзины от самой старой к текущей
+        for age in range(self.buckets - 1, -1, -1):
+            bucket = current - age
+            released += counts[bucket % self.buckets]
+            if released >= excess:
+                return max((bucket + self.buckets) * self.bucket_seconds - now, 0)
+        return self.window
+    
+    def prune(self, now=None):
+        """Удаление ключей, все корзины которых устарели"""
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        stale = [key for key, (last, _) in self._counters.items() if current - last >= self.buckets]
+        for key in stale:
+            del self._counters[key]
+    
+    def snapshot(self):
+        """Непустые корзины: {key: [номер последней корзины, [[индекс, сумма], ...]]}"""
+        return {
+            str(key): [last, [[index, count] for index, count in enumerate(counts) if count]]
+            for key, (last, counts) in self._counters.items() if any(counts)
+        }
+    
+    def restore(self, data):
+        for key, (last, items) in data.items():
+            counts = array("q", bytes(8 * self.buckets))
+            for index, count in items:
+                counts[index] = count
+            self._counters[int(key)] = [last, counts]
+
+class SQLiteWindowCounter:
+    """Счетчики в скользящем окне в общем хранилище SQLite: строка на каждую непустую корзину.
+    
+    Методы выполняют запросы через store.query и вызываются внутри store.transaction
+    """
+    
+    def __init__(self, store, name, window, buckets=60):
+        self.store = store
+        # Длина окна входит в имя: после ее изменения старые корзины не учитываются
+        self.name = f"{name}:{window}"
+        self.window = window
+        self.buckets = buckets
+        self.bucket_seconds = window / buckets
+    
+    def _counts(self, key, now):
+        """Корзины окна от самой старой к текущей: [(номер корзины, сумма), ...]"""
+        return self.store.query(
+            "SELECT bucket, count FROM quota_buckets WHERE counter = ? AND key = ? AND bucket > ? ORDER BY bucket",
+            (self.name, key, int(now // self.bucket_seconds) - self.buckets)
+        )
+    
+    def add(self, key, amount, now=None):
+        now = time.time() if now is None else now
+        self.store.query(
+            "INSERT INTO quota_buckets (counter, key, bucket, count) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(counter, key, bucket) DO UPDATE SET count = count + excluded.count",
+            (self.name, key, int(now // self.bucket_seconds), amount)
+        )
+    
+    def refund(self, key, amount, charged_at, now=None):
+        """Вычитание из корзины, в которую amount учтено в момент charged_at, если она еще в окне (не ниже нуля)"""
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        charged = int(charged_at // self.bucket_seconds)
+        if 0 <= current - charged < self.buckets:
+            self.store.query(
+                "UPDATE quota_buckets SET count = MAX(count - ?, 0) WHERE counter = ? AND key = ? AND bucket = ?",
+                (amount, self.name, key, charged)
+            )
+    
+    def total(self, key, now=None):
+        return sum(count for _, count in self._counts(key, time.time() if now is None else now))
+    
+    def retry_in(self, key, excess, now=None):
+        """Через сколько секунд из окна выйдет не меньше excess единиц"""
+        now = time.time() if now is None else now
+        released = 0
+        for bucket, count in self._counts(key, now):
+            released += count
+            if released >= excess:
+                return max((bucket + self.buckets) * self.bucket_seconds - now, 0)
+        return self.window
+    
+    def prune(self, now=None):
+        """Удаление устаревших корзин"""
+        current = int((time.time() if now is None else now) // self.bucket_seconds)
+        self.store.query("DELETE FROM quota_buckets WHERE counter = ? AND bucket <= ?", (self.name, current - self.buckets))
+
+class QuotaExceededError(Exception):
+    """Превышена квота пользователя или чата"""
+    
+    def __init__(self, metric, scope, limit, window, retry_in=None):
+        super().__init__(f"Превышена квота {metric} ({scope}): {limit} за {window} сек.")
+        self.metric = metric
+        self.scope = scope  # user или chat
+        self.limit = limit
+        self.window = window
+        self.retry_in = retry_in  # None - запрос больше всей квоты
+
+class QuotaManager:
+    """Квоты на запросы, токены и изображения для пользователей и групповых чатов по тарифам (счетчики в памяти процесса)"""
+    
+    METRICS = ("requests", "tokens", "images")
+    
+    def __init__(self, tiers, user_tiers, chat_tier, windows, snapshot_path=None):
+        self.tiers = tiers  # Тариф -> {метрика: лимит за окно}
+        self.user_tiers = user_tiers  # id пользователя -> тариф
+        self.chat_tier = chat_tier
+        self.windows = windows
+        self.snapshot_path = snapshot_path
+        self.rejected = {metric: 0 for metric in self.METRICS}
+        self._counters = {
+            (metric, scope): self._create_counter(metric, scope) for metric in self.METRICS for scope in ("user", "chat")
+        }
+        if snapshot_path:
+            self._load()
+    
+    def _create_counter(self, metric, scope):
+        return SlidingWindowCounter(self.windows[metric])
+    
+    async def _run(self, function):
+        """Выполнение function() над счетчиками"""
+        return function()
+    
+    def tier(self, user_id):
+        return self.user_tiers.get(user_id, "default")
+    
+    def _scopes(self, user_id, chat_id):
+        scopes = [("user", user_id, self.tiers.get(self.tier(user_id), {}))]
+        # В личном чате id чата совпадает с id пользователя, общий лимит нужен только группам
+        if chat_id is not None and chat_id != user_id:
+            scopes.append(("chat", chat_id, self.tiers.get(self.chat_tier, {})))
+        return scopes
+    
+    async def acquire(self, user_id, chat_id, requests=1, images=0, check_tokens=False):
+        """Проверка квот до обращения к API и учет запроса; возвращает время учета (для refund).
+        
+        При превышении - исключение QuotaExceededError
+        """
+        amounts = {"requests": requests}
+        if images:
+            amounts["images"] = images
+        if check_tokens:
+            # Токены учитываются после ответа модели, поэтому проверяется только, что квота еще не исчерпана
+            amounts["tokens"] = 0
+        return await self._run(lambda: self._acquire(user_id, chat_id, amounts, time.time()))
+    
+    def _acquire(self, user_id, chat_id, amounts, now):
+        for scope, key, limits in self._scopes(user_id, chat_id):
+            for metric, amount in amounts.items():
+                limit = limits.get(metric, 0)
+                if not limit:
+                    continue
+                counter = self._counters[(metric, scope)]
+                excess = counter.total(key, now) + max(amount, 1) - limit
+                if excess > 0:
+                    self.rejected[metric] += 1
+                    retry_in = counter.retry_in(key, excess, now) if amount <= limit else None
+                    raise QuotaExceededError(metric, scope, limit, counter.window, retry_in)
+        for scope, key, _ in self._scopes(user_id, chat_id):
+            for metric, amount in amounts.items():
+                if amount:
+                    self._counters[(metric, scope)].add(key, amount, now)
+        return now
+    
+    async def charge(self, user_id, chat_id, tokens):
+        """Учет токенов из ответа модели"""
+        def add():
+            for scope, key, _ in self._scopes(user_id, chat_id):
+                self._counters[("tokens", scope)].add(key, tokens)
+        
+        await self._run(add)
+    
+    async def refund(self, user_id, chat_id, charged_at, requests=0, images=0):
+        """Возврат в квоту учтенного в момент charged_at, но не израсходованного (изображения из кэша, ошибки)"""
+        amounts = {"requests": requests, "images": images}
+        
+        def subtract():
+            now = time.time()
+            for scope, key, _ in self._scopes(user_id, chat_id):
+                for metric, amount in amounts.items():
+                    if amount:
+                        self._counters[(metric, scope)].refund(key, amount, charged_at, now)
+        
+        await self._run(subtract)
+    
+    async def usage(self, user_id):
+        """Расход пользователя: {метрика: (израсходовано, лимит, окно в сек.)}"""
+        limits = self.tiers.get(self.tier(user_id), {})
+        return await self._run(lambda: {
+            metric: (self._counters[(metric, "user")].total(user_id), limits.get(metric, 0), self.windows[metric])
+            for metric in self.METRICS
+        })
+    
+    def _load(self):
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            for name, data in snapshot.get("counters", {}).items():
+                metric, scope = name.split(":")
+                counter = self._counters.get((metric, scope))
+                if counter is not None and snapshot.get("windows", {}).get(metric) == counter.window:
+                    counter.restore(data)
+            logger.info(f"Счетчики квот восстановлены из {self.snapshot_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Не удалось восстановить счетчики квот: {e}")
+    
+    def _write_snapshot(self, snapshot):
+        snapshot_dir = os.path.dirname(self.snapshot_path)
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+        # Запись во временный файл и замена, чтобы при сбое не остался поврежденный снимок
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(temporary_path, self.snapshot_path)
+    
+    async def save(self):
+        """Сохранение снимка счетчиков на диск (запись в отдельном потоке)"""
+        if not self.snapshot_path:
+            return
+        for counter in self._counters.values():
+            counter.prune()
+        snapshot = {
+            "windows": self.windows,
+            "counters": {f"{metric}:{scope}": counter.snapshot() for (metric, scope), counter in self._counters.items()},
+        }
+        await asyncio.to_thread(self._write_snapshot, snapshot)
+
+class SQLiteQuotaManager(QuotaManager):
+    """Квоты со счетчиками в общем хранилище SQLite: лимиты общие для всех рабочих процессов"""
+    
+    def __init__(self, store, tiers, user_tiers, chat_tier, windows):
+        self.store = store
+        super().__init__(tiers, user_tiers, chat_tier, windows)
+    
+    def _create_counter(self, metric, scope):
+        return SQLiteWindowCounter(self.store, f"{metric}:{scope}", self.windows[metric])
+    
+    async def _run(self, function):
+        # Проверка и учет в одной транзакции: одновременные запросы разных процессов не превысят лимит вместе
+        return await self.store.transaction(function)
+    
+    async def save(self):
+        """Удаление устаревших корзин (снимок не нужен: счетчики уже хранятся в базе)"""
+        names = [counter.name for counter in self._counters.values()]
+        
+        def prune():
+            for counter in self._counters.values():
+                counter.prune()
+            # Корзины счетчиков с прежней длиной окна
+            self.store.query(f"DELETE FROM quota_buckets WHERE counter NOT IN ({', '.join('?' * len(names))})", names)
+        
+        await self._run(prune)
+
+def load_quota_tiers(config):
+    """Встроенные тарифы и тарифы из QUOTA_TIERS"""
+    default = {"requests": QUOTA_REQUESTS, "tokens": QUOTA_TOKENS, "images": QUOTA_IMAGES}
+    tiers = {
+        "default": default,
+        # Групповой чат по умолчанию может израсходовать впятеро больше одного пользователя
+        "chat": {metric: limit * 5 for metric, limit in default.items()},
+        "unlimited": {},
+    }
+    if config:
+        tiers.update(json.loads(config))
+    return tiers
+
+quota_settings = (
+    load_quota_tiers(QUOTA_TIERS),
+    {int(user_id): tier for user_id, tier in json.loads(QUOTA_USER_TIERS or "{}").items()},
+    QUOTA_CHAT_TIER,
+    {"requests": QUOTA_REQUESTS_WINDOW, "tokens": QUOTA_TOKENS_WINDOW, "images": QUOTA_IMAGES_WINDOW},
+)
+# При хранилище sqlite счетчики общие для всех рабочих процессов, иначе - в памяти со снимком на диске
+if STORAGE_BACKEND == "sqlite":
+    quotas = SQLiteQuotaManager(shared_store, *quota_settings)
+else:
+    quotas = QuotaManager(*quota_settings, QUOTA_SNAPSHOT_PATH)
+
+metrics.register(GaugeFunc(
+    "bot_quota_rejections_total", "Запросы, отклоненные из-за превышения квоты",
+    lambda: {(metric,): count for metric, count in quotas.rejected.items()}, ("metric",),
+    metric_type="counter"
+))
+
+def format_duration(seconds):
+    """Длительность для сообщений пользователю: сек., мин. или ч."""
+    seconds = max(int(seconds), 1)
+    if seconds < 60:
+        return f"{seconds} сек."
+    if seconds < 60 * 60:
+        return f"{seconds // 60} мин."
+    return f"{seconds // 3600} ч."
+
+def quota_message(error):
+    """Сообщение пользователю о превышении квоты"""
+    names = {"requests": "запросов", "tokens": "токенов", "images": "изображений"}
+    owner = "для этого чата" if error.scope == "chat" else "для вас"
+    if error.retry_in is None:
+        return f"Запрос превышает лимит {names[error.metric]} {owner}: не больше {error.limit} за {format_duration(error.window)}"
+    return (
+        f"Лимит {names[error.metric]} {owner} исчерпан. Попробуйте через {format_duration(error.retry_in)}\n"
+        "Текущий расход: /usage"
+    )
+
+async def save_quotas_periodically():
+    """Периодическое сохранение счетчиков квот на диск"""
+    while True:
+        await asyncio.sleep(QUOTA_SNAPSHOT_INTERVAL)
+        try:
+            await quotas.save()
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при отправке действия чата: {e}")
-            return False
+            logger.error(f"Ошибка при сохранении счетчиков квот: {e}")
+
+# Функция для безопасной отправки сообщений с повторными попытками
+async def safe_send_message(chat_id, text, reply_markup=None, retries=3, wait=True):
+    """Отправка сообщения через очередь исходящих (возвращает сообщение или False; при wait=False - True сразу)"""
+    future = outbound.submit(
+        chat_id,
+        "send_message",
+        lambda: bot.send_message(chat_id, text, reply_markup=reply_markup),
+        retries=retries,
+        background=not wait
+    )
+    if not wait:
+        return True
+    try:
+        return await future
+    except Exception:
+        # Ошибка уже записана в лог очередью исходящих
+        return False
+
+# Функция для отправки действия чата
+async def safe_send_chat_action(chat_id, action):
+    """Отправка действия чата в фоне (повторы одного действия объединяются)"""
+    outbound.send_chat_action(chat_id, action)
+    return True
+
+# Функция для безопасного редактирования сообщения
+async def safe_edit_message_text(chat_id, message_id, text, wait=True, retries=None):
+    """Безопасное редактирование текста сообщения (при wait=False - в фоне и по умолчанию без повторных попыток)"""
+    if retries is None:
+        # Промежуточную правку заменит следующая, а итоговая должна дойти
+        retries = 3 if wait else 1
+    future = outbound.edit_message_text(chat_id, message_id, text, retries=retries, background=not wait)
+    if not wait:
+        return True
+    try:
+        await future
+        return True
+    except Exception:
+        return False
+
+@dp.message.middleware()
+async def measure_handler_duration(handler, event, data):
+    """Промежуточный обработчик для измерения полного времени обработки сообщения"""
+    handler_object = data.get("handler")
+    name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+    with metric_handler_duration.time(handler=name):
+        return await handler(event, data)
 
 @dp.message(CommandStart())
 async def cmd_start(message: Message):
@@ -132,22 +2474,16 @@ async def cmd_start(message: Message):
     global last_activity_time
     last_activity_time = time.time()
     
-    try:
-        await message.answer(
-            "Привет! Я бот, который использует API DeepInfra для генерации текстов и Stability AI для генерации изображений.\n\n"
-            "Используйте кнопки меню или следующие команды:\n"
-            "/help - Получить справку\n"
-            "/image - Сгенерировать изображение по текстовому описанию",
-            reply_markup=main_keyboard
-        )
-        logger.info(f"Пользователь {message.from_user.id} запустил бота")
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API при отправке приветствия: {e}")
-        await safe_send_message(
-            message.chat.id,
-            "Произошла ошибка при отправке приветствия. Пожалуйста, попробуйте еще раз с помощью /start.",
-            reply_markup=main_keyboard
-        )
+    # Ответ идет через очередь исходящих: лимиты чата и flood wait соблюдаются, ошибки записываются в лог
+    await safe_send_message(
+        message.chat.id,
+        "Привет! Я бот, который использует API DeepInfra для генерации текстов и Stability AI для генерации изображений.\n\n"
+        "Используйте кнопки меню или следующие команды:\n"
+        "/help - Получить справку\n"
+        "/image - Сгенерировать изображение по текстовому описанию",
+        reply_markup=main_keyboard
+    )
+    logger.info(f"Пользователь {message.from_user.id} запустил бота")
 
 @dp.message(Command("help"))
 async def cmd_help(message: Message):
@@ -155,24 +2491,63 @@ async def cmd_help(message: Message):
     global last_activity_time
     last_activity_time = time.time()
     
-    try:
-        await message.answer(
-            "Доступные команды:\n"
-            "/start - Начать работу с ботом\n"
-            "/help - Показать эту справку\n"
-            "/image - Сгенерировать изображение по текстовому описанию\n\n"
-            "Вы также можете использовать кнопки меню для выбора действий.\n"
-            "Просто напишите сообщение, чтобы получить ответ от ИИ.",
-            reply_markup=main_keyboard
-        )
-        logger.info(f"Пользователь {message.from_user.id} запросил справку")
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API при отправке справки: {e}")
-        await safe_send_message(
-            message.chat.id,
-            "Произошла ошибка при отправке справки. Пожалуйста, попробуйте еще раз.",
-            reply_markup=main_keyboard
-        )
+    await safe_send_message(
+        message.chat.id,
+        "Доступные команды:\n"
+        "/start - Начать работу с ботом\n"
+        "/help - Показать эту справку\n"
+        "/image - Сгенерировать изображение по текстовому описанию\n"
+        "/reset - Начать диалог заново (очистить историю)\n"
+        "/nocache - Отключить или включить готовые ответы на частые вопросы\n"
+        "/usage - Показать расход запросов, токенов и изображений\n\n"
+        "Вы также можете использовать кнопки меню для выбора действий.\n"
+        "Просто напишите сообщение, чтобы получить ответ от ИИ.",
+        reply_markup=main_keyboard
+    )
+    logger.info(f"Пользователь {message.from_user.id} запросил справку")
+
+@dp.message(Command("reset"))
+async def cmd_reset(message: Message):
+    """Обработчик команды /reset - очистка истории диалога"""
+    global last_activity_time
+    last_activity_time = time.time()
+    
+    await conversation_memory.clear(message.chat.id)
+    await safe_send_message(message.chat.id, "История диалога очищена. Начнем сначала!", reply_markup=main_keyboard)
+    logger.info(f"Пользователь {message.from_user.id} очистил историю диалога")
+
+@dp.message(Command("nocache"))
+async def cmd_nocache(message: Message):
+    """Обработчик команды /nocache - отключение и включение ответов из кэша для чата"""
+    global last_activity_time
+    last_activity_time = time.time()
+    
+    key = f"response_cache_off:{message.chat.id}"
+    disabled = not await shared_store.get_value(key, False)
+    await shared_store.set_value(key, disabled)
+    if disabled:
+        text = "Готовые ответы из кэша отключены: на каждый вопрос будет сформирован новый ответ. Повторите /nocache, чтобы включить их снова."
+    else:
+        text = "Готовые ответы из кэша снова включены."
+    await safe_send_message(message.chat.id, text, reply_markup=main_keyboard)
+    logger.info(f"Пользователь {message.from_user.id} {'отключил' if disabled else 'включил'} ответы из кэша")
+
+@dp.message(Command("usage"))
+async def cmd_usage(message: Message):
+    """Обработчик команды /usage - расход квот пользователя"""
+    global last_activity_time
+    last_activity_time = time.time()
+    
+    if not QUOTAS_ENABLED:
+        await safe_send_message(message.chat.id, "Ограничения на число запросов отключены.", reply_markup=main_keyboard)
+        return
+    names = {"requests": "Запросы", "tokens": "Токены", "images": "Изображения"}
+    lines = [f"Ваш тариф: {quotas.tier(message.from_user.id)}"]
+    for metric, (used, limit, window) in (await quotas.usage(message.from_user.id)).items():
+        period = format_duration(window)
+        lines.append(f"{names[metric]}: {used} из {limit} за {period}" if limit else f"{names[metric]}: {used} за {period} (без ограничения)")
+    await safe_send_message(message.chat.id, "\n".join(lines), reply_markup=main_keyboard)
+    logger.info(f"Пользователь {message.from_user.id} запросил расход квот")
 
 @dp.message(F.text == "❓ Помощь")
 async def button_help(message: Message):
@@ -190,24 +2565,21 @@ async def cmd_image(message: Message, state: FSMContext):
     global last_activity_time
     last_activity_time = time.time()
     
-    try:
-        await message.answer(
-            "Опишите изображение, которое хотите сгенерировать:",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[[KeyboardButton(text="Отмена")]],
-                resize_keyboard=True,
-                one_time_keyboard=True
-            )
+    sent_message = await safe_send_message(
+        message.chat.id,
+        "Опишите изображение, которое хотите сгенерировать:\n\n"
+        "Дополнительно можно указать: --n 4 (несколько вариантов), "
+        "--ar 16:9 (соотношение сторон, можно несколько через запятую), --seed 42",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="Отмена")]],
+            resize_keyboard=True,
+            one_time_keyboard=True
         )
+    )
+    # Без приглашения пользователь не знает, что следующее сообщение станет описанием изображения
+    if sent_message:
         await state.set_state(BotStates.waiting_for_image_prompt)
         logger.info(f"Пользователь {message.from_user.id} запросил генерацию изображения")
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API при запросе генерации изображения: {e}")
-        await safe_send_message(
-            message.chat.id,
-            "Произошла ошибка при обработке команды. Пожалуйста, попробуйте позже.",
-            reply_markup=main_keyboard
-        )
 
 @dp.message(F.text == "Отмена", BotStates.waiting_for_image_prompt)
 async def cancel_action(message: Message, state: FSMContext):
@@ -216,22 +2588,29 @@ async def cancel_action(message: Message, state: FSMContext):
     last_activity_time = time.time()
     
     await state.clear()
-    try:
-        await message.answer("Действие отменено.", reply_markup=main_keyboard)
-        logger.info(f"Пользователь {message.from_user.id} отменил действие")
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API при отмене действия: {e}")
-        await safe_send_message(
-            message.chat.id,
-            "Действие отменено.",
-            reply_markup=main_keyboard
-        )
+    await safe_send_message(message.chat.id, "Действие отменено.", reply_markup=main_keyboard)
+    logger.info(f"Пользователь {message.from_user.id} отменил действие")
 
-async def translate_to_english(text, retries=MAX_RETRIES):
-    """Функция для перевода текста на английский с помощью DeepInfra с автоматическими повторными попытками"""
+async def translate_to_english(text, retries=MAX_RETRIES, owner=None):
+    """Функция для перевода текста на английский с использованием кэша переводов"""
+    cache_key = normalize_prompt(text)
+    translation = await translation_cache.get(cache_key)
+    if translation is not None:
+        stats = translation_cache.stats()
+        logger.info(f"Перевод взят из кэша (попаданий: {stats['hits']}, промахов: {stats['misses']})")
+        return translation
+    
+    with metric_stage_duration.time(stage="translation"):
+        translation = await request_translation(text, retries, owner)
+    if translation is None:
+        return text  # Возвращаем исходный текст, если перевести не удалось
+    await translation_cache.set(cache_key, translation)
+    return translation
+
+async def request_translation(text, retries=MAX_RETRIES, owner=None):
+    """Функция для перевода текста на английский с помощью DeepInfra с автоматическими повторными попытками (None при неудаче)"""
     # Подготовка данных для запроса к API DeepInfra
     data = {
-        "model": "meta-llama/Meta-Llama-3-8B-Instruct",
         "messages": [
             {"role": "system", "content": "Ты переводчик с русского на английский. Переведи текст пользователя на английский язык. Дай только перевод без дополнительных комментариев."},
             {"role": "user", "content": text}
@@ -240,48 +2619,160 @@ async def translate_to_english(text, retries=MAX_RETRIES):
         "temperature": 0.3
     }
     
-    retry_count = 0
-    while retry_count < retries:
+    async def read_translation(response):
+        response_json = await response.json()
+        return response_json["choices"][0]["message"]["content"]
+    
+    try:
+        translation = await single_flight.do(
+            request_key("translate", data),
+            lambda: translate_router.request(data, 30, read_translation, owner=owner, retries=retries)
+        )
+        logger.info(f"Перевод успешно получен")
+        return translation
+    except UpstreamError as e:
+        logger.warning(f"Не удалось получить перевод ({e.status}). Возвращаем исходный текст.")
+        return None
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при переводе: {str(e)}")
+        return None
+
+def save_debug_image(filename, image_data):
+    """Сохранение копии сгенерированного изображения для отладки"""
+    try:
+        os.makedirs(DEBUG_IMAGES_DIR, exist_ok=True)
+        with open(os.path.join(DEBUG_IMAGES_DIR, filename), "wb") as f:
+            f.write(image_data)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении отладочной копии изображения: {e}")
+
+def parse_image_options(text):
+    """Извлечение параметров генерации (--n, --seed, --ar) из текста запроса"""
+    options = {"samples": 1, "seeds": [0], "ratios": ["1:1"]}
+    for name, value in IMAGE_OPTION_PATTERN.findall(text):
+        name = name.lower()
+        values = [v for v in value.split(",") if v]
+        if name == "n" and value.isdigit():
+            options["samples"] = min(max(int(value), 1), IMAGE_MAX_SAMPLES, IMAGE_MAX_IMAGES)
+        elif name == "seed":
+            seeds = [int(v) for v in values if v.isdigit()]
+            if seeds:
+                options["seeds"] = seeds
+        elif name == "ar":
+            ratios = [v for v in values if v in IMAGE_ASPECT_RATIOS]
+            if ratios:
+                options["ratios"] = ratios
+    return IMAGE_OPTION_PATTERN.sub("", text).strip(), options
+
+def build_image_requests(english_prompt, options):
+    """Запросы к Stability для всех сочетаний соотношения сторон и seed (не больше IMAGE_MAX_IMAGES изображений)"""
+    requests = []
+    for ratio in options["ratios"]:
+        width, height = IMAGE_ASPECT_RATIOS[ratio]
+        for seed in options["seeds"]:
+            data = {
+                "text_prompts": [
+                    {
+                        "text": english_prompt,
+                        "weight": 1.0
+                    }
+                ],
+                "cfg_scale": 7,
+                "height": height,
+                "width": width,
+                "samples": options["samples"],
+                "steps": 30
+            }
+            if seed:
+                data["seed"] = seed
+            requests.append(data)
+    return requests[:max(IMAGE_MAX_IMAGES // options["samples"], 1)]
+
+def decode_artifacts(body):
+    """Декодирование изображений из JSON-ответа Stability без построения строк и словарей для всего ответа"""
+    view = memoryview(body)
+    # a2b_base64 читает срез ответа напрямую, без промежуточной копии
+    images = [binascii.a2b_base64(view[match.start(1):match.end(1)]) for match in ARTIFACT_BASE64_PATTERN.finditer(body)]
+    if not images:
+        # Нестандартное оформление JSON (например, экранированные символы)
+        images = [base64.b64decode(artifact["base64"]) for artifact in json.loads(body)["artifacts"]]
+    return images
+
+async def read_generation(response):
+    """Чтение ответа Stability: (тип содержимого, тело ответа в байтах)"""
+    return response.content_type, await response.read()
+
+async def generate_images(data, owner, on_queued=None, on_rate_limited=None):
+    """Генерация изображений одним запросом к Stability; возвращает список PNG в памяти"""
+    generation_started = time.perf_counter()
+    # Одинаковые одновременные запросы выполняются одной генерацией
+    content_type, body = await single_flight.do(
+        request_key(STABILITY_TEXT_TO_IMAGE_URL, data),
+        lambda: upstream_request(
+            "stability",
+            "stability",
+            STABILITY_TEXT_TO_IMAGE_URL,
+            stability_png_headers if data["samples"] == 1 else stability_headers,
+            data,
+            60,  # Увеличенный таймаут для генерации изображений
+            read_generation,
+            owner=owner,
+            on_queued=on_queued,
+            on_rate_limited=on_rate_limited
+        )
+    )
+    metric_stage_duration.observe(time.perf_counter() - generation_started, stage="generation")
+    
+    if content_type == "image/png":
+        return [body]
+    # Декодирование в отдельном потоке, чтобы не останавливать цикл событий на несколько мегабайт base64
+    with metric_stage_duration.time(stage="base64_decode"):
+        return await asyncio.to_thread(decode_artifacts, body)
+
+async def send_images(chat_id, images, caption):
+    """Отправка изображений (PNG в памяти или file_id) одним фото или альбомом; возвращает file_id отправленных фото"""
+    timestamp = int(time.time())
+    media = [
+        image if isinstance(image, str) else BufferedInputFile(image, f"generated_image_{chat_id}_{timestamp}_{i}.png")
+        for i, image in enumerate(images)
+    ]
+    with metric_stage_duration.time(stage="upload"):
+        if len(media) == 1:
+            sent_message = await outbound.submit(
+                chat_id, "send_photo", lambda: bot.send_photo(chat_id, media[0], caption=caption, reply_markup=main_keyboard)
+            )
+            return [sent_message.photo[-1].file_id]
+        # Все изображения загружаются одним запросом send_media_group
+        sent_messages = await outbound.submit(
+            chat_id,
+            "send_media_group",
+            lambda: bot.send_media_group(
+                chat_id,
+                [InputMediaPhoto(media=item, caption=caption if i == 0 else None) for i, item in enumerate(media)]
+            )
+        )
+        return [sent_message.photo[-1].file_id for sent_message in sent_messages]
+
+async def count_uncached_images(prompt, image_options):
+    """Число изображений, которых нет в кэше file_id (если перевод запроса еще неизвестен - все запрошенные).
+    
+    Кэши только просматриваются: попадания и промахи учтет generate_and_send_images
+    """
+    english_prompt = prompt if is_english(prompt) else await translation_cache.peek(normalize_prompt(prompt))
+    image_requests = build_image_requests(english_prompt or prompt, image_options)
+    if english_prompt is None:
+        return sum(data["samples"] for data in image_requests)
+    cached_file_ids = await asyncio.gather(*(image_cache.peek(image_cache_key(data)) for data in image_requests))
+    return sum(data["samples"] for data, file_ids in zip(image_requests, cached_file_ids) if not file_ids)
+
+async def release_image_quota(job, generated):
+    """Возврат в квоту изображений, учтенных при постановке задачи, но не сгенерированных (из кэша или из-за ошибки)"""
+    charge = job.options.get("quota")
+    if charge and charge["images"] > generated:
         try:
-            # Асинхронная отправка запроса к API DeepInfra
-            async with aiohttp.ClientSession() as session:
-                async with session.post(DEEPINFRA_API_URL, headers=deepinfra_headers, json=data, timeout=30) as response:
-                    if response.status == 200:
-                        # Извлечение ответа из JSON
-                        response_json = await response.json()
-                        translation = response_json["choices"][0]["message"]["content"]
-                        logger.info(f"Перевод успешно получен")
-                        return translation
-                    elif response.status == 429:  # Rate limit
-                        retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-                        logger.warning(f"Превышен лимит запросов API (429). Повторная попытка через {retry_delay:.2f} сек.")
-                        await asyncio.sleep(retry_delay)
-                    else:
-                        logger.error(f"Ошибка перевода: {response.status}")
-                        error_text = await response.text()
-                        logger.error(f"Детали ошибки: {error_text}")
-                        
-                        # Для некоторых ошибок нет смысла повторять запрос
-                        if response.status in [400, 401, 403]:
-                            return text
-                        
-                        # Для других ошибок делаем паузу и повторяем
-                        retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-                        logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
-                        await asyncio.sleep(retry_delay)
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            logger.error(f"Ошибка сети при переводе: {str(e)}")
-            retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-            logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
-            await asyncio.sleep(retry_delay)
+            await quotas.refund(job.user_id, job.chat_id, charge["at"], images=charge["images"] - generated)
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при переводе: {str(e)}")
-            return text
-            
-        retry_count += 1
-    
-    logger.warning(f"Исчерпаны все попытки перевода. Возвращаем исходный текст.")
-    return text  # Возвращаем исходный текст после всех неудачных попыток
+            logger.error(f"Ошибка при возврате квоты изображений задачи {job.id}: {e}")
 
 @dp.message(BotStates.waiting_for_image_prompt)
 async def process_image_prompt(message: Message, state: FSMContext):
@@ -289,186 +2780,663 @@ async def process_image_prompt(message: Message, state: FSMContext):
     global last_activity_time
     last_activity_time = time.time()
     
-    prompt = message.text
+    # Параметры генерации (--n, --seed, --ar) отделяются от описания изображения
+    prompt, image_options = parse_image_options(message.text)
     # Проверка длины запроса
     if len(prompt) > MAX_INPUT_LENGTH:
-        try:
-            await message.answer(
-                f"Извините, ваш запрос слишком длинный. Максимальная длина: {MAX_INPUT_LENGTH} символов.",
-                reply_markup=main_keyboard
-            )
-        except TelegramAPIError as e:
-            logger.error(f"Ошибка Telegram API при отправке сообщения о превышении длины: {e}")
-            await safe_send_message(
-                message.chat.id,
-                f"Извините, ваш запрос слишком длинный. Максимальная длина: {MAX_INPUT_LENGTH} символов.",
-                reply_markup=main_keyboard
-            )
-        
+        await safe_send_message(
+            message.chat.id,
+            f"Извините, ваш запрос слишком длинный. Максимальная длина: {MAX_INPUT_LENGTH} символов.",
+            reply_markup=main_keyboard
+        )
         await state.clear()
         return
     
+    if not prompt:
+        # Состояние сохраняется, чтобы пользователь мог отправить описание еще раз
+        await safe_send_message(message.chat.id, "Пожалуйста, опишите изображение словами.")
+        return
+    
     # Сброс состояния
     await state.clear()
+    await shared_store.incr("image_requests")
     
-    # Отправка индикатора загрузки
-    await safe_send_chat_action(message.chat.id, "typing")
+    # Квота изображений учитывает все запрошенные варианты (--n, --seed, --ar), кроме уже сгенерированных ранее
+    if QUOTAS_ENABLED:
+        images = await count_uncached_images(prompt, image_options)
+        try:
+            charged_at = await quotas.acquire(message.from_user.id, message.chat.id, images=images)
+        except QuotaExceededError as e:
+            logger.info(f"Запрос изображения пользователя {message.from_user.id} отклонен: {e}")
+            await safe_send_message(message.chat.id, quota_message(e), reply_markup=main_keyboard)
+            return
+        # Задача вернет в квоту изображения, которые не пришлось генерировать
+        image_options["quota"] = {"images": images, "at": charged_at}
     
-    # Перевод запроса на английский язык
-    try:
-        await safe_send_message(
-            message.chat.id,
-            "Перевожу ваш запрос на английский для лучшей генерации изображения..."
+    # Генерация выполняется обработчиками очереди, обработчик обновления только сохраняет задачу.
+    # Подтверждение становится сообщением о ходе генерации, которое задача редактирует на месте
+    ahead = await image_jobs.pending()
+    if ahead:
+        status_message = await safe_send_message(
+            message.chat.id, f"Запрос принят. Задач в очереди перед вашей: {ahead}.", reply_markup=main_keyboard
         )
-        english_prompt = await translate_to_english(prompt)
-        
-        # Отправка индикатора загрузки для генерации изображения
-        await safe_send_chat_action(message.chat.id, "upload_photo")
+    else:
+        status_message = await safe_send_message(message.chat.id, "Запрос принят, начинаю генерацию.", reply_markup=main_keyboard)
+    status_message_id = status_message.message_id if status_message else None
+    try:
+        job_id = await image_jobs.enqueue(message.chat.id, message.from_user.id, prompt, image_options, status_message_id)
     except Exception as e:
-        logger.error(f"Ошибка при переводе запроса: {e}")
-        await safe_send_message(
-            message.chat.id,
-            "Произошла ошибка при переводе запроса. Попробуем использовать оригинальный текст.",
-            reply_markup=main_keyboard
+        logger.error(f"Ошибка при постановке задачи генерации изображения в очередь: {e}")
+        if QUOTAS_ENABLED:
+            await quotas.refund(message.from_user.id, message.chat.id, charged_at, requests=1, images=images)
+        error_message = "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
+        if status_message_id is not None:
+            await safe_edit_message_text(message.chat.id, status_message_id, error_message)
+        else:
+            await safe_send_message(message.chat.id, error_message, reply_markup=main_keyboard)
+        return
+    logger.info(f"Задача генерации изображения {job_id} пользователя {message.from_user.id} поставлена в очередь")
+
+class ImageJobStatus:
+    """Сообщение о ходе генерации, которое редактируется на месте вместо отправки новых"""
+    
+    def __init__(self, chat_id, message_id=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+    
+    async def update(self, text, wait=False):
+        """Новый текст статуса; правка отправляется в фоне, параллельно с запросами к API (при wait=True - с ожиданием)"""
+        if self.message_id is None:
+            # Подтверждение не было отправлено: статус отправляется новым сообщением
+            sent_message = await safe_send_message(self.chat_id, text, reply_markup=main_keyboard)
+            if sent_message:
+                self.message_id = sent_message.message_id
+            return bool(sent_message)
+        return await safe_edit_message_text(self.chat_id, self.message_id, text, wait=wait)
+    
+    def clear(self):
+        """Удаление статуса после доставки изображений (в фоне)"""
+        if self.message_id is None:
+            return
+        chat_id, message_id = self.chat_id, self.message_id
+        self.message_id = None
+        # С приоритетом правок, чтобы удаление выполнилось после ожидающих правок этого сообщения.
+        # Удаление итоговое, поэтому повторяется при flood wait, как и другие итоговые запросы
+        outbound.submit(
+            chat_id, "delete_message", lambda: bot.delete_message(chat_id, message_id),
+            priority=OutboundDispatcher.PRIORITY_EDIT, background=True
         )
+
+@contextlib.asynccontextmanager
+async def keep_chat_action(chat_id, action):
+    """Повторная отправка действия чата, пока выполняется долгая операция (Telegram показывает действие ~5 сек.)"""
+    async def repeat():
+        while True:
+            await safe_send_chat_action(chat_id, action)
+            await asyncio.sleep(CHAT_ACTION_INTERVAL)
+    
+    task = asyncio.create_task(repeat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+async def run_image_job(job):
+    """Выполнение задачи генерации: перевод, генерация и отправка изображений; True, если изображения доставлены"""
+    status = ImageJobStatus(job.chat_id, job.status_message_id)
+    if job.attempts > IMAGE_JOB_MAX_ATTEMPTS:
+        # Задача несколько раз прерывалась падением процесса или откладывалась
+        logger.error(f"Задача генерации изображения {job.id} не выполнена за {IMAGE_JOB_MAX_ATTEMPTS} попыток")
+        await status.update("К сожалению, не удалось сгенерировать изображение. Пожалуйста, попробуйте позже.", wait=True)
+        await release_image_quota(job, 0)
+        return False
+    
+    # Индикатор отправки фото держится все время выполнения задачи
+    async with keep_chat_action(job.chat_id, "upload_photo"):
+        delivered = await generate_and_send_images(job, status)
+    # Задача завершена (отложенная задача сюда не доходит): квота расходуется только на сгенерированные изображения
+    await release_image_quota(job, job.generated)
+    return delivered
+
+async def generate_and_send_images(job, status):
+    """Перевод запроса, генерация недостающих изображений и отправка; True, если изображения доставлены"""
+    chat_id, user_id, prompt, image_options = job.chat_id, job.user_id, job.prompt, job.options
+    if is_english(prompt):
+        # Запрос уже на английском: перевод не нужен
         english_prompt = prompt
+        caption = split_message(f"Сгенерированное изображение по запросу:\n\n{prompt}", MAX_CAPTION_LENGTH)[0]
+    else:
+        # Перевод запроса на английский язык
+        await status.update("Перевожу ваш запрос на английский для лучшей генерации изображения...")
+        try:
+            english_prompt = await translate_to_english(prompt, owner=user_id)
+        except Exception as e:
+            logger.error(f"Ошибка при переводе запроса: {e}")
+            await status.update("Произошла ошибка при переводе запроса. Попробуем использовать оригинальный текст.")
+            english_prompt = prompt
+        caption = split_message(f"Сгенерированное изображение по запросу:\n\n🇷🇺 {prompt}\n\n🇬🇧 {english_prompt}", MAX_CAPTION_LENGTH)[0]
     
-    # Подготовка данных для запроса к API Stability
-    data = {
-        "text_prompts": [
-            {
-                "text": english_prompt,
-                "weight": 1.0
-            }
-        ],
-        "cfg_scale": 7,
-        "height": 1024,
-        "width": 1024,
-        "samples": 1,
-        "steps": 30
-    }
+    # Подготовка запросов к API Stability: по одному на каждое сочетание seed и соотношения сторон
+    image_requests = build_image_requests(english_prompt, image_options)
+    
+    # Повторная отправка уже сгенерированных изображений по file_id
+    cache_keys = [image_cache_key(data) for data in image_requests]
+    cached_file_ids = await asyncio.gather(*(image_cache.get(key) for key in cache_keys))
+    if all(cached_file_ids):
+        try:
+            await send_images(chat_id, [file_id for file_ids in cached_file_ids for file_id in file_ids], caption)
+            status.clear()
+            logger.info(f"Изображение из кэша отправлено пользователю {user_id}")
+            return True
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось отправить изображение из кэша, генерируем заново: {e}")
+            cached_file_ids = [None] * len(image_requests)
     
     # Проверка наличия ключа API
     if not STABILITY_API_KEY:
-        await safe_send_message(
-            message.chat.id,
-            "Извините, ключ API для генерации изображений не настроен.",
-            reply_markup=main_keyboard
+        await status.update("Извините, ключ API для генерации изображений не настроен.", wait=True)
+        return False
+    
+    async def notify_queued(position):
+        await status.update(f"Сейчас много запросов. Ваш запрос в очереди, позиция: {position}. Пожалуйста, подождите...")
+    
+    async def notify_rate_limited(delay):
+        await status.update(f"Превышен лимит запросов к API. Повторная попытка через {int(delay)} сек...")
+    
+    try:
+        await status.update("Генерирую изображение...")
+        # Все недостающие варианты генерируются параллельно
+        missing = [i for i, file_ids in enumerate(cached_file_ids) if not file_ids]
+        generated = await asyncio.gather(*(
+            generate_images(image_requests[i], user_id, notify_queued, notify_rate_limited)
+            for i in missing
+        ))
+        generated_by_request = dict(zip(missing, generated))
+        
+        # Изображения (file_id из кэша или PNG в памяти) в порядке запросов
+        images = []
+        for i, file_ids in enumerate(cached_file_ids):
+            images.extend(file_ids or generated_by_request[i])
+        
+        if SAVE_DEBUG_IMAGES:
+            for i, image_data in enumerate(image for image in images if isinstance(image, bytes)):
+                await asyncio.to_thread(save_debug_image, f"generated_image_{user_id}_{int(time.time())}_{i}.png", image_data)
+        
+        # Отправка изображений пользователю
+        try:
+            sent_file_ids = await send_images(chat_id, images, caption)
+        except TelegramAPIError as e:
+            logger.error(f"Ошибка при отправке изображения: {e}")
+            # Повторная попытка отправки из тех же буферов
+            try:
+                sent_file_ids = await send_images(chat_id, images, caption)
+            except Exception as e2:
+                logger.error(f"Вторая попытка отправки изображения также не удалась: {e2}")
+                await status.update("Произошла ошибка при отправке изображения. Попробуйте позже.", wait=True)
+                return False
+        status.clear()
+        job.generated = sum(image_requests[i]["samples"] for i in missing)
+        logger.info(f"Изображения ({len(images)}) успешно отправлены пользователю {user_id}")
+        
+        # Сохранение file_id сгенерированных изображений для мгновенной повторной отправки
+        position = 0
+        for i, file_ids in enumerate(cached_file_ids):
+            count = len(file_ids or generated_by_request[i])
+            if not file_ids:
+                await image_cache.set(cache_keys[i], sent_file_ids[position:position + count])
+            position += count
+        return True
+    except CircuitOpenError as e:
+        retry_in = max(int(e.retry_in), 1)
+        if job.attempts < IMAGE_JOB_MAX_ATTEMPTS:
+            # Задача остается в очереди и будет выполнена автоматически после восстановления сервиса
+            await status.update(
+                f"Сервис генерации изображений временно недоступен. Изображение будет сгенерировано автоматически примерно через {retry_in} сек."
+            )
+            raise ImageJobDeferred(retry_in)
+        await status.update(
+            f"Сервис генерации изображений временно недоступен. Пожалуйста, попробуйте через {retry_in} сек.", wait=True
         )
-        return
+        return False
+    except UpstreamError as e:
+        if e.retryable:
+            # Если все попытки исчерпаны
+            error_message = "К сожалению, не удалось сгенерировать изображение после нескольких попыток. Пожалуйста, попробуйте позже."
+        else:
+            # Более информативное сообщение об ошибке
+            error_message = "Извините, произошла ошибка при генерации изображения."
+            if e.status == 401:
+                error_message += " Проблема с аутентификацией API."
+            elif e.status == 400:
+                error_message += " Некорректный запрос. Возможно, в запросе есть запрещенный контент."
+        await status.update(error_message, wait=True)
+        return False
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при генерации изображения: {str(e)}")
+        await status.update("Произошла неожиданная ошибка при генерации изображения. Попробуйте позже.", wait=True)
+        return False
+
+def estimate_tokens(text):
+    """Быстрая локальная оценка числа токенов (без токенизатора модели)"""
+    # Для смешанного русского и английского текста в среднем около 3 символов на токен
+    return len(text) // 3 + 4
+
+class ChatHistory:
+    """История одного чата: последние сообщения и краткое содержание более старых"""
+    
+    __slots__ = ("messages", "summary", "pending", "last_active", "summarizing")
     
-    retry_count = 0
-    while retry_count < MAX_RETRIES:
+    def __init__(self, max_messages):
+        self.messages = deque(maxlen=max_messages)  # (role, content, tokens)
+        self.summary = ""
+        self.pending = []  # Вытесненные сообщения, ожидающие сжатия в summary
+        self.last_active = time.monotonic()
+        self.summarizing = False
+
+class ConversationMemory:
+    """Ограниченная по объему память диалогов в памяти процесса с вытеснением неактивных чатов"""
+    
+    def __init__(self, max_messages, token_budget, idle_ttl, max_chats, summarize=False):
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        self.summarize = summarize
+        self._chats = OrderedDict()  # chat_id -> ChatHistory, от давно неактивных к недавним
+    
+    def _get(self, chat_id, create=False):
+        history = self._chats.get(chat_id)
+        if history is None and create:
+            history = ChatHistory(self.max_messages)
+            self._chats[chat_id] = history
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        if history is not None:
+            history.last_active = time.monotonic()
+            self._chats.move_to_end(chat_id)
+        return history
+    
+    def _fit_context(self, system_prompt, user_message, messages, summary):
+        """Сообщения истории (role, content, tokens) и краткое содержание, которые помещаются в бюджет токенов"""
+        budget = self.token_budget - estimate_tokens(system_prompt) - estimate_tokens(user_message)
+        context = []
+        # Добавляем сообщения от новых к старым, пока они помещаются в бюджет
+        for role, content, tokens in reversed(messages):
+            if tokens > budget:
+                break
+            budget -= tokens
+            context.append({"role": role, "content": content})
+        context.reverse()
+        if summary and estimate_tokens(summary) <= budget:
+            context.insert(0, {"role": "system", "content": f"Краткое содержание предыдущего разговора: {summary}"})
+        return [{"role": "system", "content": system_prompt}, *context, {"role": "user", "content": user_message}]
+    
+    async def build_messages(self, chat_id, system_prompt, user_message):
+        """Формирование списка сообщений для запроса в пределах бюджета токенов"""
+        history = self._get(chat_id)
+        if history is None:
+            return self._fit_context(system_prompt, user_message, (), "")
+        return self._fit_context(system_prompt, user_message, history.messages, history.summary)
+    
+    async def add_exchange(self, chat_id, user_message, answer):
+        """Сохранение вопроса пользователя и ответа ассистента"""
+        history = self._get(chat_id, create=True)
+        for role, content in (("user", user_message), ("assistant", answer)):
+            if self.summarize and len(history.messages) == history.messages.maxlen:
+                history.pending.append(history.messages[0])
+            history.messages.append((role, content, estimate_tokens(content)))
+        if self.summarize and len(history.pending) >= 4 and not history.summarizing:
+            history.summarizing = True
+            asyncio.create_task(self._summarize(chat_id, history))
+    
+    async def _summarize(self, chat_id, history):
+        """Фоновое сжатие вытесненных сообщений в краткое содержание"""
+        pending, history.pending = history.pending, []
         try:
-            # Асинхронная отправка запроса к API Stability
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    STABILITY_TEXT_TO_IMAGE_URL, 
-                    headers=stability_headers, 
-                    json=data,
-                    timeout=60  # Увеличенный таймаут для генерации изображений
-                ) as response:
-                    if response.status == 200:
-                        # Извлечение изображения из ответа
-                        response_json = await response.json()
-                        
-                        # Получение base64-закодированного изображения
-                        for i, image in enumerate(response_json["artifacts"]):
-                            image_data = base64.b64decode(image["base64"])
-                            
-                            # Создание директории для временных файлов, если она не существует
-                            os.makedirs("temp", exist_ok=True)
-                            
-                            # Сохранение изображения во временный файл
-                            image_path = f"temp/generated_image_{message.from_user.id}_{int(time.time())}_{i}.png"
-                            with open(image_path, "wb") as f:
-                                f.write(image_data)
-                            
-                            # Отправка изображения пользователю
-                            try:
-                                await message.answer_photo(
-                                    FSInputFile(image_path),
-                                    caption=f"Сгенерированное изображение по запросу:\n\n🇷🇺 {prompt}\n\n🇬🇧 {english_prompt}",
-                                    reply_markup=main_keyboard
-                                )
-                                logger.info(f"Изображение успешно отправлено пользователю {message.from_user.id}")
-                            except TelegramAPIError as e:
-                                logger.error(f"Ошибка при отправке изображения: {e}")
-                                # Повторная попытка отправки с использованием другого метода
-                                try:
-                                    with open(image_path, "rb") as photo:
-                                        await bot.send_photo(
-                                            message.chat.id,
-                                            photo,
-                                            caption=f"Сгенерированное изображение по запросу:\n\n🇷🇺 {prompt}\n\n🇬🇧 {english_prompt}",
-                                            reply_markup=main_keyboard
-                                        )
-                                except Exception as e2:
-                                    logger.error(f"Вторая попытка отправки изображения также не удалась: {e2}")
-                                    await safe_send_message(
-                                        message.chat.id,
-                                        "Произошла ошибка при отправке изображения. Попробуйте позже.",
-                                        reply_markup=main_keyboard
-                                    )
-                            
-                            # Удаление временного файла
-                            try:
-                                os.remove(image_path)
-                            except Exception as e:
-                                logger.error(f"Ошибка при удалении временного файла: {e}")
-                        
-                        # Успешно сгенерировали и отправили изображение, выходим из цикла
-                        return
-                    elif response.status == 429:  # Rate limit
-                        retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-                        logger.warning(f"Превышен лимит запросов API Stability (429). Повторная попытка через {retry_delay:.2f} сек.")
-                        await safe_send_message(
-                            message.chat.id,
-                            f"Превышен лимит запросов к API. Повторная попытка через {int(retry_delay)} сек..."
-                        )
-                        await asyncio.sleep(retry_delay)
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка API Stability: {response.status} - {error_text}")
-                        
-                        # Более информативное сообщение об ошибке
-                        error_message = "Извините, произошла ошибка при генерации изображения."
-                        if response.status == 401:
-                            error_message += " Проблема с аутентификацией API."
-                        elif response.status == 400:
-                            error_message += " Некорректный запрос. Возможно, в запросе есть запрещенный контент."
-                        
-                        # Для некоторых ошибок нет смысла повторять запрос
-                        if response.status in [400, 401, 403]:
-                            await safe_send_message(message.chat.id, error_message, reply_markup=main_keyboard)
-                            return
-                        
-                        # Для других ошибок делаем паузу и повторяем
-                        retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-                        logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
-                        await asyncio.sleep(retry_delay)
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            logger.error(f"Ошибка сети при генерации изображения: {str(e)}")
-            retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-            logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
-            await asyncio.sleep(retry_delay)
+            history.summary = await self._request_summary(chat_id, history.summary, pending)
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при генерации изображения: {str(e)}")
-            await safe_send_message(
-                message.chat.id,
-                "Произошла неожиданная ошибка при генерации изображения. Попробуйте позже.",
-                reply_markup=main_keyboard
-            )
-            return
-            
-        retry_count += 1
+            logger.error(f"Ошибка при сжатии истории диалога: {e}")
+        finally:
+            history.summarizing = False
     
-    # Если все попытки исчерпаны
-    await safe_send_message(
-        message.chat.id,
-        "К сожалению, не удалось сгенерировать изображение после нескольких попыток. Пожалуйста, попробуйте позже.",
-        reply_markup=main_keyboard
+    async def _request_summary(self, chat_id, summary, pending):
+        """Новое краткое содержание: прежнее вместе с вытесненными сообщениями (role, content, ...)"""
+        dialog = "\n".join(f"{role}: {content}" for role, content, *_ in pending)
+        data = {
+            "messages": [
+                {"role": "system", "content": "Кратко (не более 5 предложений) перескажи содержание диалога, сохранив важные факты. Отвечай на русском языке."},
+                {"role": "user", "content": f"{summary}\n{dialog}".strip()}
+            ],
+            "max_tokens": 200,
+            "temperature": 0.3
+        }
+        
+        async def read_summary(response):
+            response_json = await response.json()
+            return response_json["choices"][0]["message"]["content"]
+        
+        return await translate_router.request(data, 30, read_summary, owner=chat_id, retries=2)
+    
+    async def has_context(self, chat_id):
+        """Есть ли у чата сохраненная история или краткое содержание"""
+        history = self._chats.get(chat_id)
+        return history is not None and bool(history.messages or history.summary)
+    
+    async def clear(self, chat_id):
+        """Очистка истории чата"""
+        self._chats.pop(chat_id, None)
+    
+    async def evict_idle(self):
+        """Удаление историй чатов, неактивных дольше idle_ttl"""
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self._chats:
+            chat_id, history = next(iter(self._chats.items()))
+            if history.last_active >= deadline:
+                break
+            del self._chats[chat_id]
+            evicted += 1
+        return evicted
+
+class SQLiteConversationMemory(ConversationMemory):
+    """Память диалогов в общем хранилище SQLite: все рабочие процессы видят одну историю чата.
+    
+    При включенном сжатии сообщения старше последних max_messages хранятся в базе, пока их не заберет сжатие;
+    ограничение числа чатов применяется при периодической очистке
+    """
+    
+    def __init__(self, store, max_messages, token_budget, idle_ttl, max_chats, summarize=False):
+        super().__init__(max_messages, token_budget, idle_ttl, max_chats, summarize)
+        self.store = store
+        self._summarizing = set()  # Чаты, историю которых сейчас сжимает этот процесс
+    
+    async def build_messages(self, chat_id, system_prompt, user_message):
+        summary, messages = await self.store.execute_many([
+            ("SELECT summary FROM chat_memory WHERE chat_id = ?", (chat_id,)),
+            (
+                "SELECT role, content, tokens FROM "
+                "(SELECT id, role, content, tokens FROM chat_history WHERE chat_id = ? ORDER BY id DESC LIMIT ?) ORDER BY id",
+                (chat_id, self.max_messages)
+            ),
+        ])
+        return self._fit_context(system_prompt, user_message, messages, summary[0][0] if summary else "")
+    
+    async def add_exchange(self, chat_id, user_message, answer):
+        statements = [
+            (
+                "INSERT INTO chat_history (chat_id, role, content, tokens) VALUES (?, 'user', ?, ?), (?, 'assistant', ?, ?)",
+                (chat_id, user_message, estimate_tokens(user_message), chat_id, answer, estimate_tokens(answer))
+            ),
+            (
+                "INSERT INTO chat_memory (chat_id, last_active) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET last_active = excluded.last_active",
+                (chat_id, time.time())
+            ),
+        ]
+        if self.summarize:
+            # Сообщения сверх max_messages ожидают сжатия в краткое содержание
+            statements.append(("SELECT COUNT(*) - ? FROM chat_history WHERE chat_id = ?", (self.max_messages, chat_id)))
+        else:
+            statements.append((
+                "DELETE FROM chat_history WHERE chat_id = ? AND id NOT IN "
+                "(SELECT id FROM chat_history WHERE chat_id = ? ORDER BY id DESC LIMIT ?)",
+                (chat_id, chat_id, self.max_messages)
+            ))
+        *_, result = await self.store.execute_many(statements)
+        if self.summarize and result[0][0] >= 4 and chat_id not in self._summarizing:
+            self._summarizing.add(chat_id)
+            asyncio.create_task(self._summarize(chat_id))
+    
+    async def _summarize(self, chat_id):
+        try:
+            # Вытесненные сообщения удаляются одним запросом: их получит только один процесс
+            pending, summary = await self.store.execute_many([
+                (
+                    "DELETE FROM chat_history WHERE chat_id = ? AND id NOT IN "
+                    "(SELECT id FROM chat_history WHERE chat_id = ? ORDER BY id DESC LIMIT ?) RETURNING role, content, id",
+                    (chat_id, chat_id, self.max_messages)
+                ),
+                ("SELECT summary FROM chat_memory WHERE chat_id = ?", (chat_id,)),
+            ])
+            if pending and summary:
+                pending.sort(key=lambda row: row[2])
+                summary = await self._request_summary(chat_id, summary[0][0], pending)
+                # История могла быть очищена, пока готовилось краткое содержание
+                await self.store.execute("UPDATE chat_memory SET summary = ? WHERE chat_id = ?", (summary, chat_id))
+        except Exception as e:
+            logger.error(f"Ошибка при сжатии истории диалога: {e}")
+        finally:
+            self._summarizing.discard(chat_id)
+    
+    async def has_context(self, chat_id):
+        rows = await self.store.execute(
+            "SELECT EXISTS(SELECT 1 FROM chat_history WHERE chat_id = ?) "
+            "OR EXISTS(SELECT 1 FROM chat_memory WHERE chat_id = ? AND summary != '')",
+            (chat_id, chat_id)
+        )
+        return bool(rows[0][0])
+    
+    async def clear(self, chat_id):
+        await self.store.execute_many([
+            ("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,)),
+            ("DELETE FROM chat_memory WHERE chat_id = ?", (chat_id,)),
+        ])
+    
+    async def evict_idle(self):
+        """Удаление историй чатов, неактивных дольше idle_ttl, и самых давних чатов сверх max_chats"""
+        evicted = (
+            "SELECT chat_id FROM chat_memory WHERE last_active < ? "
+            "UNION SELECT chat_id FROM (SELECT chat_id FROM chat_memory ORDER BY last_active DESC LIMIT -1 OFFSET ?)"
+        )
+        params = (time.time() - self.idle_ttl, self.max_chats)
+        *_, rows = await self.store.execute_many([
+            (f"DELETE FROM chat_history WHERE chat_id IN ({evicted})", params),
+            (f"DELETE FROM chat_memory WHERE chat_id IN ({evicted}) RETURNING chat_id", params),
+        ])
+        return len(rows)
+
+# Память диалогов: при хранилище sqlite - общая для всех рабочих процессов
+if STORAGE_BACKEND == "sqlite":
+    conversation_memory = SQLiteConversationMemory(
+        shared_store,
+        CHAT_HISTORY_MAX_MESSAGES,
+        CHAT_HISTORY_TOKEN_BUDGET,
+        CHAT_HISTORY_IDLE_TTL,
+        CHAT_HISTORY_MAX_CHATS,
+        CHAT_HISTORY_SUMMARY
     )
+else:
+    conversation_memory = ConversationMemory(
+        CHAT_HISTORY_MAX_MESSAGES,
+        CHAT_HISTORY_TOKEN_BUDGET,
+        CHAT_HISTORY_IDLE_TTL,
+        CHAT_HISTORY_MAX_CHATS,
+        CHAT_HISTORY_SUMMARY
+    )
+
+async def cleanup_conversation_memory():
+    """Периодическое удаление историй неактивных чатов"""
+    while True:
+        await asyncio.sleep(300)
+        try:
+            evicted = await conversation_memory.evict_idle()
+        except Exception as e:
+            logger.error(f"Ошибка при очистке истории диалогов: {e}")
+            continue
+        if evicted:
+            logger.info(f"Удалена история {evicted} неактивных чатов")
+
+def utf16_length(text):
+    """Длина текста так, как ее считает Telegram: в единицах UTF-16 (символы вне BMP занимают две)"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+def find_message_break(window):
+    """Место разбиения окна текста: (конец части, начало следующей) по самой крупной границе во второй половине окна"""
+    for separator in MESSAGE_BREAKS:
+        position = window.rfind(separator, len(window) // 2)
+        if position != -1:
+            if separator.isspace():
+                return position, position + len(separator)
+            # Знак препинания остается в текущей части
+            return position + 1, position + len(separator)
+    return len(window), len(window)
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Разбиение текста на части не длиннее limit (в единицах UTF-16) по абзацам, предложениям или словам.
+    
+    Блок кода, разрезанный между частями, закрывается в одной части и открывается заново в следующей
+    """
+    if utf16_length(text) <= limit:
+        return [text]
+    # При очень маленьком limit блоки кода не переоткрываются: на закрытие и открытие ушла бы вся часть
+    fence_reserve = len("\n```") if "```" in text and limit >= 16 else 0
+    parts = []
+    start = 0
+    prefix = ""  # Открытие блока кода, перенесенного из предыдущей части
+    in_fence = False
+    fence_language = ""
+    while start < len(text):
+        budget = limit - utf16_length(prefix)
+        window = text[start:start + budget]
+        excess = utf16_length(window) - budget
+        while excess > 0:
+            # Символ занимает одну или две единицы UTF-16: сокращение на половину превышения не отрезает лишнего
+            window = window[:len(window) - (excess + 1) // 2]
+            excess = utf16_length(window) - budget
+        if start + len(window) >= len(text):
+            parts.append(prefix + window)
+            break
+        window = window[:len(window) - fence_reserve]
+        end, resume = find_message_break(window)
+        if not resume:
+            # В окно не поместился ни один символ (limit меньше символа): часть из одного символа, чтобы разбиение продвигалось
+            end = resume = 1
+            window = text[start:start + 1]
+        part = window[:end]
+        if fence_reserve:
+            for match in CODE_FENCE_PATTERN.finditer(part):
+                in_fence = not in_fence
+                fence_language = match.group(1) if in_fence else ""
+        part = prefix + part.rstrip()
+        if in_fence:
+            part += "\n```"
+            prefix = f"```{fence_language}\n"
+            # Открытие блока занимает не больше половины части: слишком длинное название языка отбрасывается
+            if utf16_length(prefix) + fence_reserve > limit // 2:
+                prefix = "```\n"
+        else:
+            prefix = ""
+        parts.append(part)
+        start += resume
+        # Переводы строк на границе частей не переносятся в следующую часть
+        while start < len(text) and text[start] == "\n":
+            start += 1
+    return [part for part in parts if part.strip()] or [""]
+
+class StreamInterruptedError(Exception):
+    """Потоковый ответ прерван после того, как часть текста уже отправлена пользователю"""
+
+async def iter_stream_deltas(response, usage=None):
+    """Разбор SSE-потока OpenAI-совместимого API: выдает фрагменты текста по мере поступления (расход токенов - в usage)"""
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            break
+        chunk = json.loads(payload)
+        if usage is not None and chunk.get("usage"):
+            usage.update(chunk["usage"])
+        choices = chunk.get("choices") or []
+        if choices:
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+async def send_streaming_answer(chat_id, response, usage=None):
+    """Отправка ответа по мере генерации: первое сообщение сразу, затем редактирование с ограничением частоты (возвращает весь текст)"""
+    current_message = None  # Сообщение, которое сейчас дописывается
+    requested_text = ""  # Последний текст, отправленный в текущее сообщение (правка может быть еще в очереди)
+    shown_text = ""  # Текст текущего сообщения, доставку которого подтвердил Telegram
+    text = ""
+    full_text = ""
+    last_edit_time = 0
+    first_message = True
+    
+    def confirm_edit(message_id, future):
+        nonlocal shown_text
+        # Фоновая правка могла не дойти: видимым считается только подтвержденный текст
+        if future.cancelled() or future.exception() is not None:
+            return
+        if current_message is not None and current_message.message_id == message_id and len(future.result()) > len(shown_text):
+            shown_text = future.result()
+    
+    async def publish(part, final=False):
+        nonlocal current_message, requested_text, shown_text, last_edit_time, first_message
+        if current_message is None:
+            current_message = await safe_send_message(
+                chat_id,
+                part,
+                reply_markup=main_keyboard if first_message else None
+            )
+            if not current_message:
+                raise RuntimeError("Не удалось отправить начало потокового ответа")
+            first_message = False
+            requested_text = shown_text = part
+            last_edit_time = time.monotonic()
+        elif final:
+            await finish_message(part)
+        elif part != requested_text and time.monotonic() - last_edit_time >= STREAM_EDIT_INTERVAL:
+            # Промежуточные правки уходят в фоне и не задерживают чтение ответа
+            message_id = current_message.message_id
+            future = outbound.edit_message_text(chat_id, message_id, part, retries=1, background=True)
+            future.add_done_callback(lambda done: confirm_edit(message_id, done))
+            requested_text = part
+            last_edit_time = time.monotonic()
+    
+    async def finish_message(part):
+        """Итоговый текст сообщения: правка ждет flood wait и повторяется, а если не дошла, недостающий текст отправляется новым сообщением"""
+        nonlocal shown_text
+        if part != shown_text:
+            try:
+                shown_text = await outbound.edit_message_text(chat_id, current_message.message_id, part, retries=MAX_RETRIES)
+            except Exception:
+                # Ошибка уже записана в лог очередью исходящих
+                remainder = part[len(shown_text):] if part.startswith(shown_text) else part
+                if remainder.strip() and not await safe_send_message(chat_id, remainder.strip()):
+                    raise RuntimeError("Не удалось отправить окончание потокового ответа")
+                logger.warning(f"Окончание потокового ответа в чате {chat_id} отправлено отдельным сообщением")
+    
+    try:
+        async for delta in iter_stream_deltas(response, usage):
+            text += delta
+            full_text += delta
+            # Переход к новому сообщению при превышении MAX_MESSAGE_LENGTH (длина в UTF-16 не больше удвоенной)
+            if len(text) * 2 > MAX_MESSAGE_LENGTH and utf16_length(text) > MAX_MESSAGE_LENGTH:
+                *complete, text = split_message(text)
+                for part in complete:
+                    await publish(part, final=True)
+                    current_message = None
+            if text.strip():
+                await publish(text)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if first_message:
+            raise
+        raise StreamInterruptedError(str(e)) from e
+    
+    if text.strip():
+        await publish(text, final=True)
+    elif first_message:
+        raise ValueError("Пустой ответ от API")
+    return full_text
+
+async def send_answer(chat_id, answer):
+    """Отправка ответа в фоне; все части сразу ставятся в очередь чата, которая сохраняет их порядок"""
+    for i, part in enumerate(split_message(answer)):
+        await safe_send_message(chat_id, part, reply_markup=main_keyboard if i == 0 else None, wait=False)
 
 @dp.message()
 async def process_message(message: Message):
@@ -487,103 +3455,144 @@ async def process_message(message: Message):
         )
         return
     
+    await shared_store.incr("chat_requests")
+    
+    # Готовый ответ подходит только для вопроса без контекста диалога
+    use_response_cache = (
+        RESPONSE_CACHE_ENABLED
+        and not (CHAT_HISTORY_ENABLED and await conversation_memory.has_context(message.chat.id))
+        and not await shared_store.get_value(f"response_cache_off:{message.chat.id}", False)
+    )
+    if use_response_cache:
+        cached_answer = await response_cache.get(user_message)
+        if cached_answer is not None:
+            await send_answer(message.chat.id, cached_answer)
+            if CHAT_HISTORY_ENABLED:
+                await conversation_memory.add_exchange(message.chat.id, user_message, cached_answer)
+            logger.info(f"Ответ из кэша отправлен пользователю {message.from_user.id}")
+            return
+    
+    # Квоты проверяются до обращения к API
+    if QUOTAS_ENABLED:
+        try:
+            await quotas.acquire(message.from_user.id, message.chat.id, check_tokens=True)
+        except QuotaExceededError as e:
+            logger.info(f"Запрос пользователя {message.from_user.id} отклонен: {e}")
+            await safe_send_message(message.chat.id, quota_message(e), reply_markup=main_keyboard)
+            return
+    
     # Отправка индикатора набора текста
     await safe_send_chat_action(message.chat.id, "typing")
     
-    # Подготовка данных для запроса к API DeepInfra
-    data = {
-        "model": "meta-llama/Meta-Llama-3-8B-Instruct",  # Модель DeepInfra
-        "messages": [
-            {"role": "system", "content": "Ты полезный ассистент. Отвечай на русском языке."},
+    # Подготовка данных для запроса к API DeepInfra с учетом истории диалога
+    system_prompt = "Ты полезный ассистент. Отвечай на русском языке."
+    if CHAT_HISTORY_ENABLED:
+        messages = await conversation_memory.build_messages(message.chat.id, system_prompt, user_message)
+    else:
+        messages = [
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_message}
-        ],
+        ]
+    # Модель и эндпоинт выбирает маршрутизатор
+    data = {
+        "messages": messages,
         "max_tokens": 800,
-        "temperature": 0.7
+        "temperature": 0.7,
+        "stream": STREAM_RESPONSES
     }
+    if STREAM_RESPONSES:
+        # Расход токенов для квот приходит последним фрагментом потока
+        data["stream_options"] = {"include_usage": True}
+    usage = {}
     
-    retry_count = 0
-    while retry_count < MAX_RETRIES:
-        try:
-            # Асинхронная отправка запроса к API DeepInfra
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    DEEPINFRA_API_URL, 
-                    headers=deepinfra_headers, 
-                    json=data,
-                    timeout=30
-                ) as response:
-                    if response.status == 200:
-                        # Извлечение ответа из JSON
-                        response_json = await response.json()
-                        answer = response_json["choices"][0]["message"]["content"]
-                        
-                        # Разделение длинного ответа на части
-                        if len(answer) <= MAX_MESSAGE_LENGTH:
-                            await safe_send_message(message.chat.id, answer, reply_markup=main_keyboard)
-                        else:
-                            # Разделение ответа на части по MAX_MESSAGE_LENGTH символов
-                            for i in range(0, len(answer), MAX_MESSAGE_LENGTH):
-                                part = answer[i:i + MAX_MESSAGE_LENGTH]
-                                if i == 0:
-                                    await safe_send_message(message.chat.id, part, reply_markup=main_keyboard)
-                                else:
-                                    await safe_send_message(message.chat.id, part)
-                        
-                        logger.info(f"Успешно отправлен ответ пользователю {message.from_user.id}")
-                        return
-                    elif response.status == 429:  # Rate limit
-                        retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-                        logger.warning(f"Превышен лимит запросов API (429). Повторная попытка через {retry_delay:.2f} сек.")
-                        await asyncio.sleep(retry_delay)
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка API: {response.status} - {error_text}")
-                        
-                        # Более информативное сообщение об ошибке
-                        error_message = "Извините, произошла ошибка при обработке вашего запроса."
-                        if response.status == 404:
-                            error_message += " Сервис временно недоступен или указан неверный URL."
-                        elif response.status == 401:
-                            error_message += " Проблема с аутентификацией API."
-                        
-                        # Для некоторых ошибок нет смысла повторять запрос
-                        if response.status in [400, 401, 403]:
-                            await safe_send_message(message.chat.id, error_message, reply_markup=main_keyboard)
-                            return
-                        
-                        # Для других ошибок делаем паузу и повторяем
-                        retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-                        logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
-                        await asyncio.sleep(retry_delay)
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            logger.error(f"Ошибка сети: {str(e)}")
-            retry_delay = min(INITIAL_RETRY_DELAY * (2 ** retry_count) + random.uniform(0, 1), MAX_RETRY_DELAY)
-            logger.info(f"Повторная попытка через {retry_delay:.2f} сек.")
-            await asyncio.sleep(retry_delay)
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка: {str(e)}")
-            await safe_send_message(
-                message.chat.id,
-                "Произошла неожиданная ошибка при обработке вашего запроса. Попробуйте позже.",
-                reply_markup=main_keyboard
-            )
-            return
-            
-        retry_count += 1
+    async def read_answer(response):
+        if STREAM_RESPONSES:
+            # Потоковая отправка ответа по мере генерации
+            return await send_streaming_answer(message.chat.id, response, usage), True
+        # Извлечение ответа из JSON
+        response_json = await response.json()
+        usage.update(response_json.get("usage") or {})
+        return response_json["choices"][0]["message"]["content"], False
     
-    # Если все попытки исчерпаны
-    await safe_send_message(
-        message.chat.id,
-        "К сожалению, не удалось получить ответ после нескольких попыток. Пожалуйста, попробуйте позже.",
-        reply_markup=main_keyboard
-    )
+    try:
+        # Асинхронная отправка запроса к API DeepInfra
+        def request_answer():
+            return chat_router.request(
+                data,
+                STREAM_TIMEOUT if STREAM_RESPONSES else 30,
+                read_answer,
+                owner=message.from_user.id,
+                on_queued=queue_notifier(message.chat.id),
+                # Потоковый ответ уже отправляется пользователю, дублировать такой запрос нельзя
+                hedge=False if STREAM_RESPONSES else None
+            )
+        
+        if STREAM_RESPONSES:
+            # Потоковый ответ отправляется в конкретный чат, объединять такие запросы нельзя
+            answer, delivered = await request_answer()
+        else:
+            answer, delivered = await single_flight.do(request_key("chat", data), request_answer)
+        
+        if not delivered:
+            await send_answer(message.chat.id, answer)
+        
+        if QUOTAS_ENABLED:
+            # Без usage (объединенный запрос или API без статистики) расход оценивается по длине текста
+            tokens = usage.get("total_tokens") or sum(estimate_tokens(item["content"]) for item in messages) + estimate_tokens(answer)
+            await quotas.charge(message.from_user.id, message.chat.id, tokens)
+        if use_response_cache:
+            await response_cache.set(user_message, answer)
+        if CHAT_HISTORY_ENABLED:
+            await conversation_memory.add_exchange(message.chat.id, user_message, answer)
+        logger.info(f"Успешно отправлен ответ пользователю {message.from_user.id}")
+    except CircuitOpenError as e:
+        await safe_send_message(
+            message.chat.id,
+            f"Сервис ответов временно недоступен. Пожалуйста, попробуйте через {max(int(e.retry_in), 1)} сек.",
+            reply_markup=main_keyboard
+        )
+    except UpstreamError as e:
+        if e.retryable:
+            # Если все попытки исчерпаны
+            error_message = "К сожалению, не удалось получить ответ после нескольких попыток. Пожалуйста, попробуйте позже."
+        else:
+            # Более информативное сообщение об ошибке
+            error_message = "Извините, произошла ошибка при обработке вашего запроса."
+            if e.status == 401:
+                error_message += " Проблема с аутентификацией API."
+        await safe_send_message(message.chat.id, error_message, reply_markup=main_keyboard)
+    except StreamInterruptedError as e:
+        # Часть ответа уже у пользователя, повторный запрос привел бы к дублированию
+        logger.error(f"Потоковый ответ прерван: {str(e)}")
+        await safe_send_message(
+            message.chat.id,
+            "Ответ был прерван из-за ошибки сети. Пожалуйста, повторите запрос.",
+            reply_markup=main_keyboard
+        )
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка: {str(e)}")
+        await safe_send_message(
+            message.chat.id,
+            "Произошла неожиданная ошибка при обработке вашего запроса. Попробуйте позже.",
+            reply_markup=main_keyboard
+        )
 
 async def keep_alive():
     """Функция для поддержания бота активным на бесплатных хостингах"""
     while True:
         current_time = time.time()
+        # Время последней активности общее для всех рабочих процессов
+        activity_time = last_activity_time
+        try:
+            shared_activity_time = await shared_store.get_value("last_activity_time", 0)
+            if last_activity_time > shared_activity_time:
+                await shared_store.set_value("last_activity_time", last_activity_time)
+            activity_time = max(last_activity_time, shared_activity_time)
+            logger.info(f"Статистика обработанных запросов: {await shared_store.get_counters()}")
+        except Exception as e:
+            logger.error(f"Ошибка при обращении к общему хранилищу: {e}")
         # Если прошло больше KEEP_ALIVE_INTERVAL с последней активности
-        if current_time - last_activity_time > KEEP_ALIVE_INTERVAL:
+        if current_time - activity_time > KEEP_ALIVE_INTERVAL:
             logger.info("Выполнение keep-alive запроса...")
             try:
                 # Выполняем простой запрос к API Telegram
@@ -595,34 +3604,127 @@ async def keep_alive():
         # Проверяем каждые 5 минут
         await asyncio.sleep(300)
 
-async def check_api_availability():
-    """Функция для проверки доступности API"""
+async def check_api_availability(provider="deepinfra"):
+    """Функция для проверки доступности API (при запуске и пробными запросами автомата защиты)"""
+    name = circuit_breakers[provider].name
     try:
-        # Проверка API DeepInfra
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                DEEPINFRA_API_URL,
-                headers=deepinfra_headers,
-                json={
-                    "model": "meta-llama/Meta-Llama-3-8B-Instruct",
-                    "messages": [
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": "Hello"}
-                    ],
-                    "max_tokens": 10
-                },
-                timeout=10
-            ) as response:
-                if response.status == 200:
-                    logger.info("API DeepInfra доступен")
-                    return True
-                else:
-                    logger.warning(f"API DeepInfra недоступен, код ответа: {response.status}")
-                    return False
+        session = get_http_session()
+        if provider == "stability":
+            # Список моделей не расходует кредиты генерации
+            request = session.get(STABILITY_ENGINES_URL, headers=stability_headers, timeout=10)
+        else:
+            backend = next(
+                backend for backend in chat_router.backends + translate_router.backends if backend.provider == provider
+            )
+            if backend.models_url:
+                # Список моделей вместо генерации: быстрее и бесплатно
+                request = session.get(backend.models_url, headers=backend.headers, timeout=10)
+            else:
+                # Эндпоинт без списка моделей - короткий запрос на генерацию
+                request = session.post(
+                    backend.url,
+                    headers=backend.headers,
+                    json={
+                        "model": backend.model,
+                        "messages": [
+                            {"role": "system", "content": "You are a helpful assistant."},
+                            {"role": "user", "content": "Hello"}
+                        ],
+                        "max_tokens": 10
+                    },
+                    timeout=10
+                )
+        async with request as response:
+            if response.status == 200:
+                logger.info(f"{name} доступен")
+                return True
+            else:
+                logger.warning(f"{name} недоступен, код ответа: {response.status}")
+                return False
     except Exception as e:
-        logger.error(f"Ошибка при проверке доступности API: {e}")
+        logger.error(f"Ошибка при проверке доступности {name}: {e}")
         return False
 
+async def run_preflight_checks():
+    """Параллельная проверка доступности всех используемых провайдеров"""
+    providers = sorted({backend.provider for backend in chat_router.backends + translate_router.backends})
+    if STABILITY_API_KEY:
+        providers.append("stability")
+    results = await asyncio.gather(*(check_api_availability(provider) for provider in providers))
+    unavailable = [provider for provider, available in zip(providers, results) if not available]
+    if unavailable:
+        logger.warning(f"API недоступен при запуске ({', '.join(unavailable)}). Бот работает, но некоторые функции могут не работать.")
+    return not unavailable
+
+async def run_polling():
+    """Получение обновлений через long polling"""
+    # Вебхук мог остаться от запуска в режиме webhook и блокирует getUpdates
+    await bot.delete_webhook(drop_pending_updates=False)
+    await dp.start_polling(bot)
+
+async def run_webhook():
+    """Получение обновлений через вебхук: быстрый ответ Telegram и фоновая обработка с ограниченным параллелизмом"""
+    from aiohttp import web
+    
+    update_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    
+    async def handle_webhook(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            logger.warning("Получен запрос на вебхук с неверным секретным токеном")
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception as e:
+            logger.error(f"Ошибка разбора обновления из вебхука: {e}")
+            return web.Response(status=400)
+        try:
+            update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку обновления позже
+            logger.warning("Очередь обновлений переполнена, обновление отклонено")
+            return web.Response(status=503)
+        return web.Response()
+    
+    async def update_worker():
+        while True:
+            update = await update_queue.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                update_queue.task_done()
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    workers = []
+    try:
+        # При нескольких рабочих процессах все они слушают один порт
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=BOT_WORKERS > 1)
+        await site.start()
+        workers = [asyncio.create_task(update_worker()) for _ in range(WEBHOOK_MAX_CONCURRENCY)]
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        # Вебхук регистрирует только первый рабочий процесс
+        if BOT_WORKER_INDEX == 0:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(max(WEBHOOK_MAX_CONCURRENCY * BOT_WORKERS, 1), 100)
+            )
+            logger.info("Вебхук зарегистрирован")
+        logger.info(f"Сервер вебхука слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        # Работаем до отмены задачи
+        await asyncio.Event().wait()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await runner.cleanup()
+        await bot.session.close()
+
 async def main():
     """Основная функция запуска бота"""
     # Проверка наличия необходимых ключей API
@@ -633,31 +3735,145 @@ async def main():
         logger.warning("Предупреждение: DEEPINFRA_API_KEY не найден в переменных окружения")
     if not STABILITY_API_KEY:
         logger.warning("Предупреждение: STABILITY_API_KEY не найден в переменных окружения")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("Ошибка: для режима webhook необходимо указать WEBHOOK_URL")
+        return
+    
+    # Создание общего пула соединений к внешним API
+    global http_session
+    http_session = create_http_session()
+    
+    # Запуск эндпоинта метрик
+    metrics_runner = None
+    if METRICS_PORT:
+        try:
+            metrics_runner = await start_metrics_server()
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик: {e}")
     
-    # Создание директории для временных файлов
-    os.makedirs("temp", exist_ok=True)
+    # Запуск обработчиков очереди генерации изображений (прерванные задачи возобновляются)
+    image_jobs.start(run_image_job)
     
-    # Проверка доступности API перед запуском
-    api_available = await check_api_availability()
-    if not api_available:
-        logger.warning("API недоступен при запуске. Бот будет запущен, но некоторые функции могут не работать.")
+    if FAST_START:
+        # Проверка не задерживает начало получения обновлений
+        preflight_task = asyncio.create_task(run_preflight_checks())
+    else:
+        await run_preflight_checks()
     
     try:
         # Запуск фоновой задачи для поддержания бота активным
         keep_alive_task = asyncio.create_task(keep_alive())
+        # Запуск фоновой очистки истории неактивных чатов
+        memory_cleanup_task = asyncio.create_task(cleanup_conversation_memory())
+        # Запуск периодического сохранения счетчиков квот
+        quota_snapshot_task = asyncio.create_task(save_quotas_periodically())
         
         # Запуск бота
-        logger.info("Запуск бота...")
-        await dp.start_polling(bot)
+        logger.info(f"Запуск бота в режиме {BOT_MODE}...")
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
     except Exception as e:
         logger.critical(f"Критическая ошибка при запуске бота: {e}")
     finally:
         # Отмена фоновой задачи при завершении работы бота
         if 'keep_alive_task' in locals():
             keep_alive_task.cancel()
+        if 'memory_cleanup_task' in locals():
+            memory_cleanup_task.cancel()
+        if 'quota_snapshot_task' in locals():
+            quota_snapshot_task.cancel()
+        if 'preflight_task' in locals():
+            preflight_task.cancel()
+        for breaker in circuit_breakers.values():
+            breaker.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await image_jobs.close()
+        try:
+            await quotas.save()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении счетчиков квот: {e}")
+        # Закрытие общего пула соединений (базы данных закрываются в close_databases: main() может быть запущена повторно)
+        await close_http_session()
         logger.info("Бот остановлен")
 
+def close_databases():
+    """Закрытие соединений с базами данных кэшей, очереди задач и общего хранилища при окончательной остановке процесса"""
+    translation_cache.close()
+    image_cache.close()
+    response_cache.close()
+    image_jobs.close_db()
+    shared_store.close()
+
+def run_worker(worker_index):
+    """Точка входа рабочего процесса"""
+    global BOT_WORKER_INDEX
+    BOT_WORKER_INDEX = worker_index
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        close_databases()
+
+def run_workers(workers):
+    """Запуск и перезапуск при падении нескольких рабочих процессов"""
+    if BOT_MODE != "webhook" or STORAGE_BACKEND == "memory":
+        logger.error("Несколько рабочих процессов поддерживаются только с BOT_MODE=webhook и STORAGE_BACKEND=sqlite")
+        return
+    import multiprocessing
+    
+    # Рабочие процессы создаются копированием процесса, в котором aiogram и aiohttp уже импортированы,
+    # поэтому перезапуск после сбоя не тратит время на повторный импорт
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["aiogram", "aiohttp", "aiogram.types", "aiogram.methods"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    
+    def start(worker_index):
+        os.environ["BOT_WORKER_INDEX"] = str(worker_index)
+        process = context.Process(target=run_worker, args=(worker_index,), name=f"bot-worker-{worker_index}")
+        process.start()
+        started_at[worker_index] = time.monotonic()
+        logger.info(f"Запущен рабочий процесс {worker_index} (pid {process.pid})")
+        return process
+    
+    started_at = {}
+    restart_delays = [RESTART_DELAY] * workers
+    processes = [start(i) for i in range(workers)]
+    try:
+        while True:
+            time.sleep(1)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    # Пауза удваивается, если процесс падает сразу после запуска, и сбрасывается после минуты работы
+                    if time.monotonic() - started_at[i] > 60:
+                        restart_delays[i] = RESTART_DELAY
+                    logger.error(f"Рабочий процесс {i} завершился с кодом {process.exitcode}, перезапуск через {restart_delays[i]:.0f} сек...")
+                    time.sleep(restart_delays[i])
+                    restart_delays[i] = min(restart_delays[i] * 2, MAX_RETRY_DELAY)
+                    processes[i] = start(i)
+    except KeyboardInterrupt:
+        logger.info("Остановка рабочих процессов...")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=10)
+
 if __name__ == "__main__":
+    # Число рабочих процессов можно передать аргументом: python main.py --workers 4
+    workers = BOT_WORKERS
+    if "--workers" in sys.argv:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
+    if workers > 1:
+        BOT_WORKERS = workers
+        os.environ["BOT_WORKERS"] = str(workers)
+        run_workers(workers)
+        sys.exit(0)
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
@@ -665,9 +3881,11 @@ if __name__ == "__main__":
     except Exception as e:
         logger.critical(f"Необработанное исключение: {e}")
         # Попытка перезапуска бота при критической ошибке
-        logger.info("Попытка перезапуска бота через 10 секунд...")
-        time.sleep(10)
+        logger.info(f"Попытка перезапуска бота через {RESTART_DELAY:.0f} сек...")
+        time.sleep(RESTART_DELAY)
         try:
             asyncio.run(main())
         except Exception as e2:
             logger.critical(f"Не удалось перезапустить бота: {e2}")
+    finally:
+        close_databases()
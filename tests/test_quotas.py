@@ -0,0 +1,57 @@
+"""Тесты счетчиков квот в скользящем окне"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Бот читает настройки при импорте: кэши, очередь задач и квоты - только в памяти, логи - во временной папке
+os.environ.update(
+    LOG_DIR=tempfile.mkdtemp(prefix="bot-tests-"),
+    CACHE_DB_PATH="",
+    IMAGE_JOBS_DB_PATH="",
+    QUOTA_SNAPSHOT_PATH="",
+    STORAGE_BACKEND="memory",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import SlidingWindowCounter, SQLiteStore, SQLiteWindowCounter  # noqa: E402
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def counter(request, tmp_path):
+    """Счетчик с окном 60 сек. и корзинами по 1 сек.; call(function) выполняет function() так, как это делает QuotaManager"""
+    if request.param == "memory":
+        yield SlidingWindowCounter(60), lambda function: function()
+        return
+    store = SQLiteStore(str(tmp_path / "state.db"))
+    try:
+        yield SQLiteWindowCounter(store, "images:user", 60), lambda function: asyncio.run(store.transaction(function))
+    finally:
+        store.close()
+
+
+def test_refund_within_window(counter):
+    counter, call = counter
+    call(lambda: counter.add(1, 5, 1000.5))
+    call(lambda: counter.add(1, 2, 1030))
+    call(lambda: counter.refund(1, 3, 1000.5, 1040))
+    assert call(lambda: counter.total(1, 1040)) == 4
+
+
+def test_refund_does_not_touch_reused_bucket(counter):
+    counter, call = counter
+    call(lambda: counter.add(1, 5, 1000.9))
+    # Меньше 60 сек. по часам, но корзина 1000 уже вышла из окна и ее место в кольце занято корзиной 1060
+    call(lambda: counter.add(1, 2, 1060.5))
+    call(lambda: counter.refund(1, 5, 1000.9, 1060.5))
+    assert call(lambda: counter.total(1, 1060.5)) == 2
+
+
+def test_refund_never_goes_below_zero(counter):
+    counter, call = counter
+    call(lambda: counter.add(1, 2, 1000))
+    call(lambda: counter.refund(1, 5, 1000, 1001))
+    assert call(lambda: counter.total(1, 1001)) == 0
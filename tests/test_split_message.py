@@ -0,0 +1,112 @@
+"""Тесты разбиения длинных сообщений: split_message и utf16_length"""
+
+import os
+import random
+import sys
+import tempfile
+
+# Бот читает настройки при импорте: кэши, очередь задач и квоты - только в памяти, логи - во временной папке
+os.environ.update(
+    LOG_DIR=tempfile.mkdtemp(prefix="bot-tests-"),
+    CACHE_DB_PATH="",
+    IMAGE_JOBS_DB_PATH="",
+    QUOTA_SNAPSHOT_PATH="",
+    STORAGE_BACKEND="memory",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import MAX_MESSAGE_LENGTH, split_message, utf16_length  # noqa: E402
+
+
+def words(text):
+    """Текст без пробельных символов: разбиение может убрать их только на границах частей"""
+    return "".join(text.split())
+
+
+def fences_balanced(part):
+    return part.count("```") % 2 == 0
+
+
+def test_utf16_length():
+    assert utf16_length("") == 0
+    assert utf16_length("hello") == 5
+    assert utf16_length("привет") == 6
+    # Символы вне BMP занимают две единицы UTF-16
+    assert utf16_length("😀") == 2
+    assert utf16_length("a😀б") == 4
+
+
+def test_short_text_is_not_split():
+    assert split_message("короткий ответ") == ["короткий ответ"]
+    assert split_message("") == [""]
+    text = "я" * MAX_MESSAGE_LENGTH
+    assert split_message(text) == [text]
+
+
+def test_parts_fit_limit_and_keep_text():
+    rng = random.Random(1)
+    vocabulary = ["слово", "word", "😀", "Предложение.", "вопрос?", "\n", "\n\n", "🇷🇺", "x" * 50]
+    for limit in (16, 50, 100, 1024, MAX_MESSAGE_LENGTH):
+        text = " ".join(rng.choice(vocabulary) for _ in range(3000))
+        parts = split_message(text, limit)
+        assert all(0 < utf16_length(part) <= limit for part in parts)
+        assert words("".join(parts)) == words(text)
+
+
+def test_prefers_paragraph_and_sentence_boundaries():
+    first = "Первый абзац. " * 20
+    second = "Второй абзац. " * 20
+    parts = split_message(f"{first.strip()}\n\n{second.strip()}", 400)
+    assert parts == [first.strip(), second.strip()]
+
+    parts = split_message("Первое предложение. Второе предложение.", 30)
+    assert parts == ["Первое предложение.", "Второе предложение."]
+
+
+def test_long_word_is_split_hard():
+    text = "а" * 250
+    parts = split_message(text, 100)
+    assert parts == ["а" * 100, "а" * 100, "а" * 50]
+
+
+def test_surrogate_pairs_are_not_cut():
+    text = "😀" * 100
+    parts = split_message(text, 51)
+    assert all(utf16_length(part) <= 51 for part in parts)
+    assert "".join(parts) == text
+
+
+def test_code_fence_is_closed_and_reopened_with_language():
+    code = "\n".join(f"print({i})" for i in range(200))
+    text = f"Пример:\n\n```python\n{code}\n```\n\nГотово."
+    parts = split_message(text, 500)
+    assert len(parts) > 2
+    assert all(utf16_length(part) <= 500 for part in parts)
+    assert all(fences_balanced(part) for part in parts)
+    assert all(part.startswith("```python\n") for part in parts[1:-1])
+    assert words("".join(parts).replace("```python", "").replace("```", "")) == words(
+        text.replace("```python", "").replace("```", "")
+    )
+
+
+def test_long_fence_language_does_not_exceed_limit():
+    text = "```" + "x" * 5000 + "\n" + "код " * 2000 + "\n```"
+    parts = split_message(text)
+    assert all(utf16_length(part) <= MAX_MESSAGE_LENGTH for part in parts)
+
+    text = "```" + "y" * 300 + "\n" + "строка кода\n" * 300 + "```"
+    parts = split_message(text, 200)
+    assert all(utf16_length(part) <= 200 for part in parts)
+    assert all(fences_balanced(part) for part in parts)
+
+
+def test_tiny_limits_terminate():
+    text = "Текст\n```python\nprint('😀')\n```\nконец"
+    for limit in range(1, 40):
+        parts = split_message(text, limit)
+        # При маленьком limit режется и сама строка ограды, поэтому сравниваем без кавычек и языка
+        assert words("".join(parts)).replace("`", "").replace("python", "") == words(text).replace(
+            "`", ""
+        ).replace("python", "")
+        # Символ длиннее limit отправляется отдельной частью: меньше разбить нельзя
+        assert all(utf16_length(part) <= max(limit, 2) for part in parts)
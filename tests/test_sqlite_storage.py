@@ -0,0 +1,37 @@
+"""Тесты хранилища состояний FSM в SQLite"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+# Бот читает настройки при импорте: кэши, очередь задач и квоты - только в памяти, логи - во временной папке
+os.environ.update(
+    LOG_DIR=tempfile.mkdtemp(prefix="bot-tests-"),
+    CACHE_DB_PATH="",
+    IMAGE_JOBS_DB_PATH="",
+    QUOTA_SNAPSHOT_PATH="",
+    STORAGE_BACKEND="memory",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Dispatcher  # noqa: E402
+
+from main import SQLiteStorage, SQLiteStore  # noqa: E402
+
+
+def test_store_survives_dispatcher_shutdown(tmp_path):
+    store = SQLiteStore(str(tmp_path / "state.db"))
+    dp = Dispatcher(storage=SQLiteStorage(store))
+    
+    async def scenario():
+        await store.set_value("nocache:1", "1")
+        await dp.emit_shutdown()
+        # После остановки диспетчера хранилищем еще пользуются возврат квот, сохранение квот и перезапуск main
+        await store.set_value("nocache:2", "1")
+        return await store.get_value("nocache:1"), await store.get_value("nocache:2")
+    
+    try:
+        assert asyncio.run(scenario()) == ("1", "1")
+    finally:
+        store.close()